@@ -1,22 +1,39 @@
-from flask import Flask, request, redirect, session, render_template
-from datetime import timedelta
-from cryptography.fernet import Fernet
-from dotenv import load_dotenv
-load_dotenv()
-import bcrypt
+from flask import Flask, request, redirect, session, render_template, g, has_app_context
+from flask import Response, stream_with_context, make_response
+from markupsafe import Markup
+from concurrent.futures import ThreadPoolExecutor
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+import click
+from datetime import date, timedelta
 import uuid
 import sqlite3, uuid
 import json
+import hashlib
+import logging
+from logging.handlers import RotatingFileHandler
 import uuid
 import os
 import time
+import queue
+import random
+import re
+import threading
+from collections import OrderedDict, deque
+from bisect import bisect_left
+import csv
+import gzip
+import io
+import zipfile
+import zlib
+from xml.sax.saxutils import escape as xml_escape
+
+# python-dotenv solo se importa cuando hay un .env que leer
+if os.path.exists(".env") or os.path.exists(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")):
+    from dotenv import load_dotenv
+    load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-cambia-esto")
-FERNET_KEY = os.environ.get("FERNET_KEY")
-if not FERNET_KEY:
-    raise RuntimeError("FERNET_KEY no definida en variables de entorno")
-fernet = Fernet(FERNET_KEY)
 app.permanent_session_lifetime = timedelta(days=365)
 app.config.update(
     SESSION_COOKIE_SECURE=False,
@@ -33,95 +50,2063 @@ RUTAS_CUESTIONARIOS = {
     "Cuestionario de Salud": "salud"
 }
 
-def db():
-    con = sqlite3.connect(DB, timeout=30)
+CAMPOS_SALUD = [
+    "enfermedad", "tratamiento", "otro_padecimiento",
+    "alergia_medicamento", "alergia_otras", "medicamentos",
+    "deporte", "suplementos", "cirugia", "fractura",
+    "autoriza", "tel_personal", "tel_casa", "contacto_emergencia"
+]
+
+# Cada escala produce un renglón en resultados. "cuenta" convierte cada
+# respuesta en 1/0 según coincida con ese valor; sin "cuenta" las
+# respuestas son enteros obligatorios. La etiqueta sale de "limites"
+# (el puntaje total cae en la primera banda cuyo límite lo alcanza) o,
+# con "subescalas", de la subescala con mayor suma. "opciones" son los
+# valores que ofrece el formulario para cada reactivo.
+ESCALAS = {
+    "Habilidades": {
+        "items": [f"r{i}" for i in range(20)],
+        "cuenta": "no",
+        "opciones": ["si", "no"],
+        "limites": [9, 12, 15],
+        "etiquetas": ["Adecuado", "Promedio", "Bajo", "Muy bajo"]
+    },
+    "Estilos de aprendizaje": {
+        "items": [f"p{i}" for i in range(1, 21)],
+        "opciones": [str(v) for v in range(1, 6)],
+        "subescalas": {
+            "Activo": ["p1", "p5", "p9", "p13", "p17"],
+            "Reflexivo": ["p2", "p6", "p10", "p14", "p18"],
+            "Teórico": ["p3", "p7", "p11", "p15", "p19"],
+            "Pragmático": ["p4", "p8", "p12", "p16", "p20"]
+        }
+    },
+    "Autoestima Rosenberg": {
+        "items": [f"p{i}" for i in range(1, 11)],
+        "opciones": [str(v) for v in range(1, 5)],
+        "limites": [15, 25],
+        "etiquetas": ["Autoestima Baja", "Autoestima Media", "Autoestima Alta"]
+    },
+    "Tamizaje - Depresión": {
+        "items": ["d1", "d2"],
+        "opciones": [str(v) for v in range(4)],
+        "limites": [2],
+        "etiquetas": ["Sin indicios", "Requiere evaluación"]
+    },
+    "Tamizaje - Ansiedad": {
+        "items": ["a1", "a2"],
+        "opciones": [str(v) for v in range(4)],
+        "limites": [2],
+        "etiquetas": ["Sin indicios", "Requiere evaluación"]
+    },
+    "Tamizaje - Alcohol": {
+        "items": ["al1", "al2", "al3"],
+        "opciones": [str(v) for v in range(5)],
+        "limites": [3],
+        "etiquetas": ["Sin riesgo", "Consumo de riesgo"]
+    },
+    "Tamizaje - Neurodivergencia": {
+        "items": [f"n{i}" for i in range(1, 18)],
+        "opciones": [str(v) for v in range(4)],
+        "limites": [16, 28, 40],
+        "etiquetas": ["No significativo", "Leve", "Moderado", "Elevado"]
+    },
+    "Cuestionario de Salud": {
+        "items": CAMPOS_SALUD,
+        "cuenta": "si",
+        "opciones": ["Si", "No"],
+        "limites": [2, 5, 8],
+        "etiquetas": ["Salud adecuada", "Riesgo leve", "Riesgo moderado", "Riesgo alto"]
+    }
+}
+
+CUESTIONARIOS = {
+    "Habilidades": ["Habilidades"],
+    "Estilos de aprendizaje": ["Estilos de aprendizaje"],
+    "Autoestima Rosenberg": ["Autoestima Rosenberg"],
+    "Batería de Tamizaje": [
+        "Tamizaje - Depresión",
+        "Tamizaje - Ansiedad",
+        "Tamizaje - Alcohol",
+        "Tamizaje - Neurodivergencia"
+    ],
+    "Cuestionario de Salud": ["Cuestionario de Salud"]
+}
+
+for escala in ESCALAS.values():
+    posiciones = {item: i for i, item in enumerate(escala["items"])}
+    if "subescalas" in escala:
+        escala["indices"] = {
+            nombre: [posiciones[item] for item in items]
+            for nombre, items in escala["subescalas"].items()
+        }
+
+def codificar(escala, respuestas):
+    if "cuenta" in escala:
+        return [
+            1 if str(respuestas.get(item, "")).lower() == escala["cuenta"] else 0
+            for item in escala["items"]
+        ]
+
+    valores = [str(respuestas.get(item, "")) for item in escala["items"]]
+    if not all(v.isdigit() for v in valores):
+        raise ValueError("faltan respuestas")
+    return [int(v) for v in valores]
+
+def etiqueta_vector(escala, vector):
+    if "subescalas" in escala:
+        sumas = {
+            nombre: sum(vector[i] for i in indices)
+            for nombre, indices in escala["indices"].items()
+        }
+        return max(sumas, key=sumas.get)
+
+    return escala["etiquetas"][bisect_left(escala["limites"], sum(vector))]
+
+def etiquetas_matriz(escala, vectores):
+    # Varias entregas a la vez (recalificar, importar). Con NumPy se
+    # califican en una sola pasada; sin NumPy se usa la misma regla por renglón.
+    try:
+        import numpy as np
+    except ImportError:
+        return [etiqueta_vector(escala, v) for v in vectores]
+
+    if not len(vectores):
+        return []
+
+    matriz = np.asarray(vectores, dtype=np.int64)
+
+    if "subescalas" in escala:
+        nombres = list(escala["indices"])
+        sumas = np.stack(
+            [matriz[:, escala["indices"][n]].sum(axis=1) for n in nombres],
+            axis=1
+        )
+        return [nombres[i] for i in sumas.argmax(axis=1)]
+
+    posiciones = np.searchsorted(escala["limites"], matriz.sum(axis=1), side="left")
+    return np.asarray(escala["etiquetas"], dtype=object)[posiciones].tolist()
+
+def calificar(cuestionario, respuestas):
+    calificaciones = []
+    for nombre in CUESTIONARIOS[cuestionario]:
+        vector = codificar(ESCALAS[nombre], respuestas)
+        calificaciones.append((nombre, etiqueta_vector(ESCALAS[nombre], vector), vector))
+    return calificaciones
+
+def filas_resultado(calificaciones):
+    return [
+        (nombre, etiqueta, None, json.dumps(vector, separators=(",", ":")))
+        for nombre, etiqueta, vector in calificaciones
+    ]
+
+app.config.update(
+    METRICAS=os.environ.get("METRICAS", "1") == "1",
+    METRICAS_TOKEN=os.environ.get("METRICAS_TOKEN")
+)
+
+CUBETAS_SEGUNDOS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metricas:
+    # Contadores e histogramas en memoria del proceso, en el formato de
+    # texto de Prometheus. Cada observación es un bisect y unas sumas bajo
+    # un lock, para poder dejarlo encendido en producción.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.definiciones = {}
+        self.histogramas = {}
+        self.contadores = {}
+
+    def definir(self, nombre, tipo, ayuda, etiquetas):
+        self.definiciones[nombre] = (tipo, ayuda, etiquetas)
+
+    def observar(self, nombre, valores, segundos):
+        cubeta = bisect_left(CUBETAS_SEGUNDOS, segundos)
+        with self.lock:
+            serie = self.histogramas.setdefault((nombre, valores), [[0] * (len(CUBETAS_SEGUNDOS) + 1), 0.0])
+            serie[0][cubeta] += 1
+            serie[1] += segundos
+
+    def contar(self, nombre, valores, cantidad=1):
+        with self.lock:
+            self.contadores[(nombre, valores)] = self.contadores.get((nombre, valores), 0) + cantidad
+
+    def texto(self, extras=()):
+        with self.lock:
+            histogramas = {clave: (list(c), s) for clave, (c, s) in self.histogramas.items()}
+            contadores = dict(self.contadores)
+
+        def etiquetas(nombres, valores, extra=()):
+            pares = [
+                f'{n}="{escapar_etiqueta(v)}"'
+                for n, v in list(zip(nombres, valores)) + list(extra)
+            ]
+            return "{" + ",".join(pares) + "}" if pares else ""
+
+        lineas = []
+        for nombre, (tipo, ayuda, nombres) in self.definiciones.items():
+            lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+            if tipo == "histogram":
+                for (serie, valores), (cuentas, suma) in sorted(histogramas.items()):
+                    if serie != nombre:
+                        continue
+                    acumulado = 0
+                    for limite, cuenta in zip(CUBETAS_SEGUNDOS + ("+Inf",), cuentas):
+                        acumulado += cuenta
+                        cubeta = etiquetas(nombres, valores, [("le", limite)])
+                        lineas.append(f"{nombre}_bucket{cubeta} {acumulado}")
+                    lineas.append(f"{nombre}_sum{etiquetas(nombres, valores)} {suma:.6f}")
+                    lineas.append(f"{nombre}_count{etiquetas(nombres, valores)} {acumulado}")
+            else:
+                for (serie, valores), total in sorted(contadores.items()):
+                    if serie == nombre:
+                        lineas.append(f"{nombre}{etiquetas(nombres, valores)} {total}")
+
+        for nombre, ayuda, valor in extras:
+            lineas += [f"# HELP {nombre} {ayuda}", f"# TYPE {nombre} gauge", f"{nombre} {valor}"]
+        return "\n".join(lineas) + "\n"
+
+def escapar_etiqueta(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+metricas = Metricas()
+metricas.definir("http_peticion_segundos", "histogram", "Duración de cada petición por ruta", ("endpoint", "metodo"))
+metricas.definir("http_respuestas_total", "counter", "Respuestas por ruta y código", ("endpoint", "codigo"))
+metricas.definir("sqlite_consulta_segundos", "histogram", "Duración de execute() por consulta normalizada", ("consulta",))
+metricas.definir("sqlite_ocupado_total", "counter", "Errores database is locked/busy", ("consulta",))
+metricas.definir("pool_espera_segundos", "histogram", "Espera por una conexión del pool", ())
+metricas.definir("cripto_segundos", "histogram", "Tiempo en Fernet y bcrypt", ("operacion",))
+
+sql_normalizado = {}
+
+def normalizar_sql(sql):
+    # Listas IN (?,?,...) de distinto largo cuentan como una sola consulta
+    clave = sql_normalizado.get(sql)
+    if clave is None:
+        clave = re.sub(r"\?(\s*,\s*\?)+", "?+", " ".join(sql.split()))
+        if len(sql_normalizado) < 5000:
+            sql_normalizado[sql] = clave
+    return clave
+
+app.config.update(
+    CONSULTAS_LENTAS_MS=float(os.environ.get("CONSULTAS_LENTAS_MS", 250)),
+    CONSULTAS_LENTAS_ARCHIVO=os.environ.get("CONSULTAS_LENTAS_ARCHIVO", "consultas_lentas.log"),
+    CONSULTAS_LENTAS_BYTES=5 * 1024 * 1024,
+    CONSULTAS_LENTAS_RESPALDOS=3
+)
+
+bitacora_lentas = None
+bitacora_lock = threading.Lock()
+
+def registro_consultas_lentas():
+    global bitacora_lentas
+    if bitacora_lentas is None:
+        with bitacora_lock:
+            if bitacora_lentas is None:
+                manejador = RotatingFileHandler(
+                    app.config["CONSULTAS_LENTAS_ARCHIVO"],
+                    maxBytes=app.config["CONSULTAS_LENTAS_BYTES"],
+                    backupCount=app.config["CONSULTAS_LENTAS_RESPALDOS"],
+                    encoding="utf-8"
+                )
+                manejador.setFormatter(logging.Formatter("%(message)s"))
+                nueva = logging.getLogger("consultas_lentas")
+                nueva.setLevel(logging.INFO)
+                nueva.propagate = False
+                nueva.addHandler(manejador)
+                bitacora_lentas = nueva
+    return bitacora_lentas
+
+def forma_parametros(parametros):
+    if isinstance(parametros, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in parametros.items()) + "}"
+    if isinstance(parametros, (list, tuple)):
+        if parametros and isinstance(parametros[0], (list, tuple, dict)):
+            return f"{len(parametros)} x {forma_parametros(parametros[0])}"
+        return "(" + ", ".join(type(v).__name__ for v in parametros) + ")"
+    return type(parametros).__name__
+
+def registrar_consulta_lenta(con, sql, parametros, segundos, filas):
+    plan = None
+    if (sql.split(None, 1) or [""])[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+        # Los valores no cambian el plan; sin ellos sirve también para executemany
+        try:
+            plan = [
+                fila[3] for fila in sqlite3.Connection.execute(
+                    con, "EXPLAIN QUERY PLAN " + sql, [None] * sql.count("?")
+                )
+            ]
+        except sqlite3.Error:
+            pass
+
+    registro_consultas_lentas().info(json.dumps({
+        "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "consulta": normalizar_sql(sql),
+        "parametros": forma_parametros(parametros),
+        "ms": round(1000 * segundos, 2),
+        "filas": filas,
+        "plan": plan
+    }, ensure_ascii=False))
+
+class CursorMedido(sqlite3.Cursor):
+    # Un SELECT hace casi todo su trabajo al leer las filas: fetchall suma
+    # ese tiempo al de execute antes de decidir si la consulta fue lenta.
+    registrada = True
+
+    def fetchall(self):
+        if self.registrada:
+            return super().fetchall()
+
+        inicio = time.perf_counter()
+        filas = super().fetchall()
+        total = self.segundos + time.perf_counter() - inicio
+        self.registrada = True
+        if total * 1000 >= app.config["CONSULTAS_LENTAS_MS"] > 0:
+            registrar_consulta_lenta(self.connection, self.sql, self.parametros, total, len(filas))
+        return filas
+
+class ConexionMedida(sqlite3.Connection):
+    def medir(self, metodo, sql, parametros):
+        cursor = self.cursor(CursorMedido)
+        inicio = time.perf_counter()
+        try:
+            getattr(cursor, metodo)(sql, parametros)
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e) or "busy" in str(e):
+                metricas.contar("sqlite_ocupado_total", (normalizar_sql(sql)[:160],))
+            raise
+        finally:
+            segundos = time.perf_counter() - inicio
+            metricas.observar("sqlite_consulta_segundos", (normalizar_sql(sql)[:160],), segundos)
+
+        umbral = app.config["CONSULTAS_LENTAS_MS"]
+        if umbral > 0:
+            if segundos * 1000 >= umbral:
+                registrar_consulta_lenta(
+                    self, sql, parametros, segundos,
+                    cursor.rowcount if cursor.rowcount >= 0 else None
+                )
+            elif metodo == "execute":
+                cursor.sql, cursor.parametros, cursor.segundos = sql, parametros, segundos
+                cursor.registrada = False
+        return cursor
+
+    def execute(self, sql, parametros=()):
+        return self.medir("execute", sql, parametros)
+
+    def executemany(self, sql, parametros):
+        return self.medir("executemany", sql, parametros)
+
+    def commit(self):
+        inicio = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            metricas.observar("sqlite_consulta_segundos", ("COMMIT",), time.perf_counter() - inicio)
+
+app.config.update(
+    DB_POOL_SIZE=int(os.environ.get("DB_POOL_SIZE", 8)),
+    DB_POOL_TIMEOUT=30,
+    SQLITE_PRAGMAS={
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 30000,
+        "cache_size": -16000,
+        "mmap_size": 64 * 1024 * 1024,
+    }
+)
+
+def conectar():
+    con = sqlite3.connect(
+        DB, timeout=30, check_same_thread=False,
+        factory=ConexionMedida
+        if app.config["METRICAS"] or app.config["CONSULTAS_LENTAS_MS"] > 0
+        else sqlite3.Connection
+    )
     con.row_factory = sqlite3.Row
-    con.execute("PRAGMA journal_mode=WAL;")
+    for nombre, valor in app.config["SQLITE_PRAGMAS"].items():
+        con.execute(f"PRAGMA {nombre}={valor}")
     return con
 
+class PoolConexiones:
+    def __init__(self, tamano, timeout):
+        self.tamano = tamano
+        self.timeout = timeout
+        self.libres = queue.LifoQueue()
+        self.cupos = threading.BoundedSemaphore(tamano)
+        self.lock = threading.Lock()
+        self.prestadas = 0
+
+    def tomar(self):
+        inicio = time.perf_counter()
+        disponible = self.cupos.acquire(timeout=self.timeout)
+        metricas.observar("pool_espera_segundos", (), time.perf_counter() - inicio)
+        if not disponible:
+            raise sqlite3.OperationalError("Sin conexiones disponibles en el pool")
+        with self.lock:
+            self.prestadas += 1
+        try:
+            return self.libres.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return conectar()
+        except Exception:
+            self.soltar()
+            raise
+
+    def devolver(self, con):
+        try:
+            if con.in_transaction:
+                con.rollback()
+        except sqlite3.Error:
+            con.close()
+        else:
+            self.libres.put(con)
+        self.soltar()
+
+    def soltar(self):
+        with self.lock:
+            self.prestadas -= 1
+        self.cupos.release()
+
+    def disponibles(self):
+        with self.lock:
+            return self.tamano - self.prestadas
+
+pool = None
+pool_lock = threading.Lock()
+
+def pool_conexiones():
+    global pool
+    if pool is None:
+        with pool_lock:
+            if pool is None:
+                pool = PoolConexiones(
+                    app.config["DB_POOL_SIZE"],
+                    app.config["DB_POOL_TIMEOUT"]
+                )
+    return pool
+
+def db():
+    # Dentro de una petición se reutiliza una sola conexión del pool;
+    # fuera de contexto (arranque) se abre una conexión suelta.
+    if not has_app_context():
+        return conectar()
+    if "db" not in g:
+        g.db = pool_conexiones().tomar()
+    return g.db
+
+@app.before_request
+def iniciar_cronometro():
+    g.inicio_peticion = time.perf_counter()
+
+def registrar_peticion(codigo):
+    g.peticion_medida = True
+    endpoint = request.endpoint or "sin_ruta"
+    metricas.observar(
+        "http_peticion_segundos", (endpoint, request.method),
+        time.perf_counter() - g.inicio_peticion
+    )
+    metricas.contar("http_respuestas_total", (endpoint, codigo))
+
+@app.after_request
+def medir_peticion(respuesta):
+    # En las respuestas en streaming (historial_salud) esto mide hasta el
+    # primer byte, no hasta el final del cuerpo.
+    if "inicio_peticion" in g:
+        registrar_peticion(respuesta.status_code)
+    return respuesta
+
+@app.teardown_request
+def medir_peticion_fallida(error):
+    # Una excepción que se propaga no pasa por after_request
+    if "inicio_peticion" in g and not g.get("peticion_medida"):
+        registrar_peticion(500)
+
+@app.teardown_appcontext
+def devolver_conexion(error):
+    con = g.pop("db", None)
+    if con is not None:
+        pool_conexiones().devolver(con)
+
+class CacheLRU:
+    # Con maximo_bytes, los valores son bytes y también se limita la suma
+    # de sus tamaños; un valor más grande que el límite no se guarda.
+    def __init__(self, maximo, maximo_bytes=None):
+        self.maximo = maximo
+        self.maximo_bytes = maximo_bytes
+        self.bytes = 0
+        self.datos = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, clave, defecto=None):
+        with self.lock:
+            if clave not in self.datos:
+                return defecto
+            self.datos.move_to_end(clave)
+            return self.datos[clave]
+
+    def put(self, clave, valor):
+        with self.lock:
+            self.quitar(clave)
+            if self.maximo_bytes is not None and len(valor) > self.maximo_bytes:
+                return
+            self.datos[clave] = valor
+            if self.maximo_bytes is not None:
+                self.bytes += len(valor)
+            while self.datos and (
+                len(self.datos) > self.maximo
+                or (self.maximo_bytes is not None and self.bytes > self.maximo_bytes)
+            ):
+                self.quitar(next(iter(self.datos)))
+
+    def quitar(self, clave):
+        valor = self.datos.pop(clave, None)
+        if valor is not None and self.maximo_bytes is not None:
+            self.bytes -= len(valor)
+
+    def pop(self, clave):
+        with self.lock:
+            self.quitar(clave)
+
+    def descartar_si(self, condicion):
+        with self.lock:
+            for clave in [c for c, v in self.datos.items() if condicion(c, v)]:
+                self.quitar(clave)
+
+    def vaciar(self):
+        with self.lock:
+            self.datos.clear()
+            self.bytes = 0
+
+# Los ids de clase y alumno no se reutilizan (AUTOINCREMENT), así que una
+# entrada vieja en otro worker nunca apunta a datos de otra clase.
+planes_clase = CacheLRU(int(os.environ.get("CACHE_PLANES", 1024)))
+clases_alumno = CacheLRU(int(os.environ.get("CACHE_ALUMNOS", 20000)))
+
+def plan_clase(clase_id):
+    plan = planes_clase.get(clase_id)
+    if plan is None:
+        plan = tuple(
+            fila["cuestionario"] for fila in db().execute("""
+                SELECT cuestionario
+                FROM clase_cuestionarios
+                WHERE clase_id=?
+                ORDER BY rowid
+            """, (clase_id,))
+        )
+        planes_clase.put(clase_id, plan)
+    return plan
+
+def clase_de_alumno(estudiante_id, con=None):
+    clase_id = clases_alumno.get(estudiante_id)
+    if clase_id is None:
+        fila = (con or db()).execute(
+            "SELECT clase_id FROM estudiantes WHERE id=?",
+            (estudiante_id,)
+        ).fetchone()
+        if not fila:
+            return None
+        clase_id = fila["clase_id"]
+        clases_alumno.put(estudiante_id, clase_id)
+    return clase_id
+
+def olvidar_clase(clase_id):
+    planes_clase.pop(clase_id)
+    clases_alumno.descartar_si(lambda _, clase: clase == clase_id)
+    detalles_salud.descartar_si(lambda _, guardado: guardado[1]["clase_id"] == clase_id)
+
+app.config.update(
+    SALUD_CACHE=int(os.environ.get("SALUD_CACHE", 256)),
+    SALUD_CACHE_SEGUNDOS=int(os.environ.get("SALUD_CACHE_SEGUNDOS", 120))
+)
+
+# Detalles de salud ya descifrados, por estudiante_id: (expira, detalle).
+# Solo viven en la memoria de este proceso y poco tiempo; en la base
+# siguen cifrados. Se vacía al cerrar sesión el admin y al eliminar o
+# archivar la clase; en los demás workers vence por tiempo.
+detalles_salud = CacheLRU(app.config["SALUD_CACHE"])
+
 MAX_INTENTOS = 5
 BLOQUEO_MINUTOS = 10
 
-def esta_bloqueado(ip):
-    with db() as con:
-        fila = con.execute(
-            "SELECT bloqueado_hasta FROM intentos_admin WHERE ip=?",
-            (ip,)
-        ).fetchone()
+app.config.update(
+    LIMITADOR_PERSISTIR=os.environ.get("LIMITADOR_PERSISTIR", "1") == "1",
+    LIMITADOR_INTERVALO=5,
+    BCRYPT_HILOS=int(os.environ.get("BCRYPT_HILOS", 2)),
+    BCRYPT_MAX_PENDIENTES=int(os.environ.get("BCRYPT_MAX_PENDIENTES", 8))
+)
 
-    return fila and fila["bloqueado_hasta"] and fila["bloqueado_hasta"] > int(time.time())
+class LimitadorIntentos:
+    # Ventana deslizante por IP en memoria; intentos_admin solo se usa
+    # como respaldo (write-behind) para sobrevivir reinicios.
+    def __init__(self, maximo, ventana, bloqueo):
+        self.maximo = maximo
+        self.ventana = ventana
+        self.bloqueo = bloqueo
+        self.fallos = {}
+        self.bloqueados = {}
+        self.pendientes = set()
+        self.lock = threading.Lock()
+        self.ultima_purga = 0
+
+    def bloqueado(self, ip):
+        ahora = time.time()
+        with self.lock:
+            self.purgar(ahora)
+            return self.bloqueados.get(ip, 0) > ahora
+
+    def fallo(self, ip):
+        ahora = time.time()
+        with self.lock:
+            fallos = self.fallos.setdefault(ip, deque())
+            fallos.append(ahora)
+            while fallos[0] <= ahora - self.ventana:
+                fallos.popleft()
+
+            if len(fallos) >= self.maximo:
+                self.bloqueados[ip] = int(ahora + self.bloqueo)
+                fallos.clear()
+
+            self.pendientes.add(ip)
+
+    def limpiar(self, ip):
+        with self.lock:
+            self.fallos.pop(ip, None)
+            self.bloqueados.pop(ip, None)
+            self.pendientes.add(ip)
+
+    def purgar(self, ahora):
+        if ahora - self.ultima_purga < 60:
+            return
+        self.ultima_purga = ahora
+
+        for ip, hasta in list(self.bloqueados.items()):
+            if hasta <= ahora:
+                del self.bloqueados[ip]
+
+        for ip, fallos in list(self.fallos.items()):
+            if not fallos or fallos[-1] <= ahora - self.ventana:
+                del self.fallos[ip]
+
+    def cargar(self, con):
+        filas = con.execute(
+            "SELECT ip, bloqueado_hasta FROM intentos_admin WHERE bloqueado_hasta > ?",
+            (int(time.time()),)
+        ).fetchall()
+        with self.lock:
+            for fila in filas:
+                self.bloqueados[fila["ip"]] = fila["bloqueado_hasta"]
+
+    def volcar(self, con):
+        with self.lock:
+            cambios = [
+                (ip, len(self.fallos.get(ip, ())), self.bloqueados.get(ip))
+                for ip in self.pendientes
+            ]
+            self.pendientes = set()
+
+        try:
+            with con:
+                for ip, intentos, hasta in cambios:
+                    if intentos or hasta:
+                        con.execute("""
+                            INSERT INTO intentos_admin (ip, intentos, bloqueado_hasta)
+                            VALUES (?,?,?)
+                            ON CONFLICT(ip) DO UPDATE
+                            SET intentos=excluded.intentos, bloqueado_hasta=excluded.bloqueado_hasta
+                        """, (ip, intentos, hasta))
+                    else:
+                        con.execute("DELETE FROM intentos_admin WHERE ip=?", (ip,))
+        except sqlite3.Error:
+            # Sin confirmar no se pierden: se guardan en el siguiente volcado
+            # con el estado que tengan entonces.
+            with self.lock:
+                self.pendientes.update(ip for ip, _, _ in cambios)
+            raise
+
+        return len(cambios)
+
+limitador = None
+limitador_lock = threading.Lock()
+
+def persistir_intentos(limitador):
+    # La conexión se abre dentro del ciclo: si la base falla al arrancar o
+    # después, el hilo sigue vivo y lo intenta de nuevo en el siguiente volcado.
+    con = None
+    while True:
+        time.sleep(app.config["LIMITADOR_INTERVALO"])
+        try:
+            if con is None:
+                con = conectar()
+            limitador.volcar(con)
+        except sqlite3.Error as e:
+            app.logger.warning("No se pudieron guardar los intentos de acceso: %s", e)
+            if con is not None:
+                try:
+                    con.close()
+                except sqlite3.Error:
+                    pass
+                con = None
+
+def limitador_intentos():
+    global limitador
+    if limitador is None:
+        with limitador_lock:
+            if limitador is None:
+                nuevo = LimitadorIntentos(
+                    MAX_INTENTOS,
+                    BLOQUEO_MINUTOS * 60,
+                    BLOQUEO_MINUTOS * 60
+                )
+                if app.config["LIMITADOR_PERSISTIR"]:
+                    nuevo.cargar(db())
+                    threading.Thread(
+                        target=persistir_intentos,
+                        args=(nuevo,),
+                        name="persistir-intentos",
+                        daemon=True
+                    ).start()
+                limitador = nuevo
+    return limitador
+
+def esta_bloqueado(ip):
+    return limitador_intentos().bloqueado(ip)
 
 def registrar_fallo(ip):
+    limitador_intentos().fallo(ip)
+
+verificador = None
+cupos_bcrypt = threading.BoundedSemaphore(app.config["BCRYPT_MAX_PENDIENTES"])
+
+def verificar_password(password, hash_guardado):
+    # None = demasiadas verificaciones en curso; el llamador responde 503
+    global verificador
+    if not cupos_bcrypt.acquire(blocking=False):
+        return None
+    try:
+        if verificador is None:
+            with limitador_lock:
+                if verificador is None:
+                    verificador = ThreadPoolExecutor(
+                        max_workers=app.config["BCRYPT_HILOS"],
+                        thread_name_prefix="bcrypt"
+                    )
+        import bcrypt
+        inicio = time.perf_counter()
+        valido = verificador.submit(
+            bcrypt.checkpw, password.encode(), hash_guardado.encode()
+        ).result()
+        metricas.observar("cripto_segundos", ("bcrypt",), time.perf_counter() - inicio)
+        return valido
+    finally:
+        cupos_bcrypt.release()
+
+# cryptography tarda en importarse; solo lo pagan los procesos que cifran
+fernet = None
+
+def cifrador():
+    global fernet
+    if fernet is None:
+        from cryptography.fernet import Fernet
+        clave = os.environ.get("FERNET_KEY")
+        if not clave:
+            raise RuntimeError("FERNET_KEY no definida en variables de entorno")
+        fernet = Fernet(clave)
+    return fernet
+
+def cifrar_respuestas(respuestas):
+    inicio = time.perf_counter()
+    cifrado = cifrador().encrypt(json.dumps(respuestas).encode()).decode()
+    metricas.observar("cripto_segundos", ("fernet_cifrar",), time.perf_counter() - inicio)
+    return cifrado
+
+def descifrar_salud(nivel, cifrado):
+    if not cifrado:
+        return nivel, None
+
+    from cryptography.fernet import InvalidToken
+    inicio = time.perf_counter()
+    try:
+        texto = cifrador().decrypt(cifrado.encode()).decode()
+    except InvalidToken:
+        # Otra clave (p. ej. rotada) o contenido dañado: el registro se
+        # queda sin respuestas, no se intenta leer el cifrado como JSON.
+        app.logger.warning("No se pudo descifrar un registro de salud")
+        return nivel, None
+    finally:
+        metricas.observar("cripto_segundos", ("fernet_descifrar",), time.perf_counter() - inicio)
+
+    # Formato anterior: todo cifrado como "nivel | respuestas"
+    if nivel is None:
+        nivel, _, texto = texto.partition(" | ")
+
+    return nivel, json.loads(texto) if texto else None
+
+CONSULTA_SALUD_SIN_NIVEL = """
+    SELECT id, resultado
+    FROM resultados
+    WHERE cuestionario_id = (SELECT id FROM cuestionarios WHERE nombre = 'Cuestionario de Salud')
+    AND etiqueta_id IS NULL
+    AND id > ?
+    ORDER BY id
+    LIMIT ?
+"""
+
+def rellenar_nivel_salud(con, lote=500, confirmar_lotes=False):
+    ultimo_id = 0
+    total = 0
+
+    while True:
+        filas = con.execute(CONSULTA_SALUD_SIN_NIVEL, (ultimo_id, lote)).fetchall()
+
+        if not filas:
+            return total
+
+        cambios = []
+        for fila in filas:
+            nivel, respuestas = descifrar_salud(None, fila["resultado"])
+            if nivel is None:
+                # No se pudo descifrar; se deja como está
+                continue
+            cambios.append((
+                codigo(con, "etiquetas", nivel),
+                cifrar_respuestas(respuestas) if respuestas is not None else None,
+                fila["id"]
+            ))
+
+        con.executemany(
+            "UPDATE resultados SET etiqueta_id=?, resultado=? WHERE id=?",
+            cambios
+        )
+
+        if confirmar_lotes:
+            con.commit()
+
+        ultimo_id = filas[-1]["id"]
+        total += len(cambios)
+
+codigos_cache = {"cuestionarios": {}, "etiquetas": {}}
+
+def sembrar_codigos(con):
+    con.executemany(
+        "INSERT OR IGNORE INTO familias (nombre) VALUES (?)",
+        [(familia,) for familia in CUESTIONARIOS]
+    )
+    con.executemany("""
+        INSERT OR IGNORE INTO cuestionarios (nombre, familia_id)
+        SELECT ?, id FROM familias WHERE nombre=?
+    """, [
+        (nombre, familia)
+        for familia, nombres in CUESTIONARIOS.items()
+        for nombre in nombres
+    ])
+    con.executemany(
+        "INSERT OR IGNORE INTO etiquetas (nombre) VALUES (?)",
+        [
+            (etiqueta,)
+            for escala in ESCALAS.values()
+            for etiqueta in escala.get("etiquetas", []) + list(escala.get("subescalas", {}))
+        ]
+    )
+
+def codigo(con, tabla, nombre):
+    # Los códigos nunca cambian una vez asignados, así que se guardan en
+    # memoria. Los de ESCALAS y CUESTIONARIOS ya están sembrados; un nombre
+    # nuevo se da de alta aquí y no entra a la memoria en esta llamada,
+    # porque si la transacción se deshace su id puede quedar para otro.
+    if nombre is None:
+        return None
+
+    cache = codigos_cache[tabla]
+    if nombre in cache:
+        return cache[nombre]
+
+    fila = con.execute(f"SELECT id FROM {tabla} WHERE nombre=?", (nombre,)).fetchone()
+    if fila:
+        cache[nombre] = fila[0]
+        return fila[0]
+
+    sembrar_codigos(con)
+    con.execute(f"INSERT OR IGNORE INTO {tabla} (nombre) VALUES (?)", (nombre,))
+    return con.execute(f"SELECT id FROM {tabla} WHERE nombre=?", (nombre,)).fetchone()[0]
+
+def filas_codificadas(con, filas):
+    # (cuestionario, resultado, nivel, respuestas) -> (cuestionario_id,
+    # etiqueta_id, contenido cifrado o None, respuestas). Con nivel (salud)
+    # la etiqueta es el nivel y resultado trae las respuestas cifradas.
+    return [
+        (
+            codigo(con, "cuestionarios", cuestionario),
+            codigo(con, "etiquetas", nivel or resultado),
+            resultado if nivel else None,
+            respuestas
+        )
+        for cuestionario, resultado, nivel, respuestas in filas
+    ]
+
+CONSULTA_PRIMERA_ENTREGA = "SELECT 1 FROM resultados WHERE estudiante_id=? LIMIT 1"
+
+def registrar_resultados(con, estudiante_id, filas):
+    # filas: (cuestionario, resultado, nivel en claro o None, respuestas o None)
+    clase_id = clase_de_alumno(estudiante_id, con)
+
+    # La clase pudo eliminarse o archivarse después de que el alumno abrió
+    # su sesión; sin ella los resultados quedarían sin clase.
+    if clase_id is None or not con.execute(
+        "SELECT 1 FROM clases WHERE id=?", (clase_id,)
+    ).fetchone():
+        raise LookupError("La clase del alumno ya no existe")
+
+    detalles_salud.pop(estudiante_id)
+    filas = filas_codificadas(con, filas)
+
+    primera_entrega = con.execute(
+        CONSULTA_PRIMERA_ENTREGA, (estudiante_id,)
+    ).fetchone() is None
+
     ahora = int(time.time())
+    con.executemany(
+        "INSERT INTO resultados (estudiante_id, cuestionario_id, etiqueta_id, resultado, respuestas, creado_en) VALUES (?,?,?,?,?,?)",
+        [(estudiante_id, c, e, r, respuestas, ahora) for c, e, r, respuestas in filas]
+    )
+
+    con.executemany("""
+        INSERT INTO resumen_resultados (clase_id, cuestionario_id, etiqueta_id, total)
+        VALUES (?,?,?,1)
+        ON CONFLICT(clase_id, cuestionario_id, etiqueta_id)
+        DO UPDATE SET total = total + 1
+    """, [(clase_id, c, e) for c, e, _, _ in filas])
+
+    dia = date.fromtimestamp(ahora)
+    conteos = {}
+    for c, e, _, _ in filas:
+        clave = (dia, clase_id, c, e)
+        conteos[clave] = conteos.get(clave, 0) + 1
+    sumar_tendencias(con, conteos)
+
+    if primera_entrega:
+        con.execute("""
+            UPDATE resumen_clases
+            SET entregados = entregados + 1
+            WHERE clase_id=?
+        """, (clase_id,))
+
+    cambiar_version(con, clase_id)
+
+PERIODOS_TENDENCIA = ("dia", "semana", "semestre")
+
+def periodos(dia):
+    # Cada entrega suma en su día, en la semana que empieza el lunes y en
+    # su semestre (enero-junio, julio-diciembre); todos se nombran por la
+    # fecha en que empiezan para poder filtrarlos por rango.
+    return [
+        ("dia", dia.isoformat()),
+        ("semana", (dia - timedelta(days=dia.weekday())).isoformat()),
+        ("semestre", date(dia.year, 1 if dia.month <= 6 else 7, 1).isoformat()),
+    ]
+
+def sumar_tendencias(con, conteos):
+    # conteos: {(fecha, clase_id, cuestionario_id, etiqueta_id): total}
+    agregados = {}
+    for (dia, clase_id, cuestionario_id, etiqueta_id), total in conteos.items():
+        for periodo, inicio in periodos(dia):
+            clave = (periodo, inicio, clase_id, cuestionario_id, etiqueta_id)
+            agregados[clave] = agregados.get(clave, 0) + total
+
+    con.executemany("""
+        INSERT INTO tendencias (periodo, inicio, clase_id, cuestionario_id, etiqueta_id, total)
+        VALUES (?,?,?,?,?,?)
+        ON CONFLICT(periodo, cuestionario_id, clase_id, inicio, etiqueta_id)
+        DO UPDATE SET total = total + excluded.total
+    """, [clave + (total,) for clave, total in agregados.items()])
+
+app.config.update(
+    ESCRITURA_AGRUPADA=os.environ.get("ESCRITURA_AGRUPADA", "0") == "1",
+    ESCRITURA_LOTE_MAX=int(os.environ.get("ESCRITURA_LOTE_MAX", 64)),
+    ESCRITURA_ESPERA_MS=int(os.environ.get("ESCRITURA_ESPERA_MS", 5)),
+    ESCRITURA_TIMEOUT=30
+)
+
+class EscritorAgrupado:
+    # Un solo hilo escribe en resultados: junta los pedidos que llegan
+    # dentro de ESCRITURA_ESPERA_MS (hasta ESCRITURA_LOTE_MAX) y los
+    # confirma en una sola transacción. Cada pedido va en su SAVEPOINT para
+    # que un error no tumbe al resto del lote.
+    def __init__(self, lote_max, espera, timeout):
+        self.lote_max = lote_max
+        self.espera = espera
+        self.timeout = timeout
+        self.cola = queue.Queue()
+        self.lock = threading.Lock()
+        self.lotes = 0
+        self.pedidos = 0
+        self.lote_maximo = 0
+        self.ultimo_lote = 0
+        self.segundos_commit = 0.0
+        self.errores = 0
+        self.con = None
+        threading.Thread(
+            target=self.correr,
+            name="escritor-resultados",
+            daemon=True
+        ).start()
+
+    def enviar(self, estudiante_id, filas):
+        pedido = {
+            "estudiante_id": estudiante_id,
+            "filas": filas,
+            "listo": threading.Event(),
+            "error": None
+        }
+        self.cola.put(pedido)
+
+        if not pedido["listo"].wait(self.timeout):
+            raise sqlite3.OperationalError("Tiempo agotado esperando la escritura de resultados")
+        if pedido["error"] is not None:
+            raise pedido["error"]
+
+    def correr(self):
+        while True:
+            lote = [self.cola.get()]
+            limite = time.monotonic() + self.espera
+
+            while len(lote) < self.lote_max:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    lote.append(self.cola.get(timeout=restante))
+                except queue.Empty:
+                    break
+
+            self.escribir(lote)
+
+    def conexion(self):
+        # Conexión propia, fuera del pool: el aviso a los alumnos significa
+        # que la entrega ya está en disco, así que hace fsync en cada commit
+        # aunque el resto use synchronous=NORMAL.
+        if self.con is None:
+            con = conectar()
+            con.execute("PRAGMA synchronous=FULL")
+            self.con = con
+        return self.con
+
+    def cerrar(self):
+        con, self.con = self.con, None
+        if con is not None:
+            try:
+                con.close()
+            except sqlite3.Error:
+                pass
+
+    def escribir(self, lote):
+        con = None
+        inicio = time.perf_counter()
+
+        try:
+            # Si no se puede abrir la conexión falla este lote, no el hilo;
+            # el siguiente lote lo vuelve a intentar.
+            con = self.conexion()
+            con.execute("BEGIN IMMEDIATE")
+            for pedido in lote:
+                con.execute("SAVEPOINT pedido")
+                try:
+                    registrar_resultados(con, pedido["estudiante_id"], pedido["filas"])
+                except Exception as e:
+                    con.execute("ROLLBACK TO pedido")
+                    pedido["error"] = e
+                con.execute("RELEASE pedido")
+            con.commit()
+        except Exception as e:
+            if isinstance(e, sqlite3.Error):
+                # No se sabe en qué estado quedó; el siguiente lote abre otra
+                self.cerrar()
+            elif con is not None and con.in_transaction:
+                con.rollback()
+            for pedido in lote:
+                pedido["error"] = pedido["error"] or e
+
+        with self.lock:
+            self.lotes += 1
+            self.pedidos += len(lote)
+            self.ultimo_lote = len(lote)
+            self.lote_maximo = max(self.lote_maximo, len(lote))
+            self.segundos_commit += time.perf_counter() - inicio
+            self.errores += sum(1 for p in lote if p["error"] is not None)
+
+        for pedido in lote:
+            pedido["listo"].set()
+
+    def estado(self):
+        with self.lock:
+            return {
+                "en_cola": self.cola.qsize(),
+                "lotes": self.lotes,
+                "pedidos": self.pedidos,
+                "errores": self.errores,
+                "ultimo_lote": self.ultimo_lote,
+                "lote_maximo": self.lote_maximo,
+                "lote_promedio": round(self.pedidos / self.lotes, 2) if self.lotes else 0,
+                "ms_commit_promedio": round(1000 * self.segundos_commit / self.lotes, 2) if self.lotes else 0
+            }
+
+escritor = None
+
+def escritor_resultados():
+    global escritor
+    if escritor is None:
+        with pool_lock:
+            if escritor is None:
+                escritor = EscritorAgrupado(
+                    app.config["ESCRITURA_LOTE_MAX"],
+                    app.config["ESCRITURA_ESPERA_MS"] / 1000,
+                    app.config["ESCRITURA_TIMEOUT"]
+                )
+    return escritor
+
+def guardar_resultados(estudiante_id, filas):
+    # Regresa cuando los resultados ya están confirmados en la base.
+    if app.config["ESCRITURA_AGRUPADA"]:
+        escritor_resultados().enviar(estudiante_id, filas)
+        return
+
+    # Con el candado de escritura tomado desde el inicio, la clase que se
+    # comprueba sigue ahí cuando se escriben los resultados.
     with db() as con:
-        fila = con.execute(
-            "SELECT intentos FROM intentos_admin WHERE ip=?",
-            (ip,)
-        ).fetchone()
+        con.execute("BEGIN IMMEDIATE")
+        registrar_resultados(con, estudiante_id, filas)
+
+def entregar(filas):
+    try:
+        guardar_resultados(session["estudiante"], filas)
+    except LookupError:
+        # Igual que una sesión revocada
+        session.clear()
+        return redirect("/")
 
-        if fila:
-            intentos = fila["intentos"] + 1
-            if intentos >= MAX_INTENTOS:
-                con.execute("""
-                    UPDATE intentos_admin
-                    SET intentos=?, bloqueado_hasta=?
-                    WHERE ip=?
-                """, (intentos, ahora + BLOQUEO_MINUTOS * 60, ip))
+    ruta = siguiente_cuestionario(session["estudiante"])
+    return redirect(f"/{ruta}" if ruta else "/final")
+
+def cambiar_version(con, clase_id):
+    # Cada escritura que cambia lo que ve un orientador sube la versión de
+    # su clase y la de la institución; de ahí salen los ETag.
+    con.execute("""
+        INSERT INTO versiones_datos (clase_id, version) VALUES (?, 1), (0, 1)
+        ON CONFLICT(clase_id) DO UPDATE SET version = version + 1
+    """, (clase_id,))
+
+def cambiar_todas_versiones(con):
+    con.execute("INSERT OR IGNORE INTO versiones_datos (clase_id, version) VALUES (0, 0)")
+    con.execute("UPDATE versiones_datos SET version = version + 1")
+
+def version_datos(con, clase_id=0):
+    fila = con.execute(
+        "SELECT version FROM versiones_datos WHERE clase_id=?",
+        (clase_id,)
+    ).fetchone()
+    return fila["version"] if fila else 0
+
+def reconstruir_resumen(con):
+    cambiar_todas_versiones(con)
+    con.execute("DELETE FROM resumen_resultados")
+    con.execute("DELETE FROM resumen_clases")
+
+    con.execute("""
+        INSERT INTO resumen_clases (clase_id, registrados, entregados)
+        SELECT clases.id,
+               COUNT(DISTINCT estudiantes.id),
+               COUNT(DISTINCT resultados.estudiante_id)
+        FROM clases
+        LEFT JOIN estudiantes ON estudiantes.clase_id = clases.id
+        LEFT JOIN resultados ON resultados.estudiante_id = estudiantes.id
+        GROUP BY clases.id
+    """)
+
+    con.execute("""
+        INSERT INTO resumen_resultados (clase_id, cuestionario_id, etiqueta_id, total)
+        SELECT estudiantes.clase_id, resultados.cuestionario_id,
+               resultados.etiqueta_id, COUNT(*)
+        FROM resultados
+        JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
+        JOIN clases ON clases.id = estudiantes.clase_id
+        WHERE resultados.etiqueta_id IS NOT NULL
+        GROUP BY estudiantes.clase_id, resultados.cuestionario_id, resultados.etiqueta_id
+    """)
+
+    # Las tendencias de clases archivadas se quedan: sus resultados ya no
+    # están en la base viva. Los resultados de antes de creado_en no tienen
+    # fecha y no entran.
+    con.execute("DELETE FROM tendencias WHERE clase_id IN (SELECT id FROM clases)")
+    conteos = {}
+    for fila in con.execute("""
+        SELECT estudiantes.clase_id, resultados.cuestionario_id, resultados.etiqueta_id,
+               date(resultados.creado_en, 'unixepoch', 'localtime') AS dia,
+               COUNT(*) AS total
+        FROM resultados
+        JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
+        JOIN clases ON clases.id = estudiantes.clase_id
+        WHERE resultados.creado_en IS NOT NULL
+        AND resultados.etiqueta_id IS NOT NULL
+        GROUP BY estudiantes.clase_id, resultados.cuestionario_id, resultados.etiqueta_id, dia
+    """):
+        clave = (
+            date.fromisoformat(fila["dia"]), fila["clase_id"],
+            fila["cuestionario_id"], fila["etiqueta_id"]
+        )
+        conteos[clave] = fila["total"]
+    sumar_tendencias(con, conteos)
+
+def m001_esquema_base(con):
+    for sql in [
+        """
+        CREATE TABLE IF NOT EXISTS clases(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT,
+            codigo TEXT UNIQUE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS clase_cuestionarios(
+            clase_id INTEGER,
+            cuestionario TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS estudiantes(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT,
+            matricula TEXT,
+            grupo TEXT,
+            carrera TEXT NOT NULL,
+            clase_id INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS resultados(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            estudiante_id INTEGER,
+            cuestionario TEXT,
+            resultado TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS intentos_admin (
+            ip TEXT PRIMARY KEY,
+            intentos INTEGER DEFAULT 0,
+            bloqueado_hasta INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS sesiones (
+            estudiante_id INTEGER PRIMARY KEY,
+            token TEXT NOT NULL,
+            user_agent TEXT,
+            creada_en INTEGER DEFAULT (strftime('%s','now')),
+            FOREIGN KEY(estudiante_id) REFERENCES estudiantes(id)
+        )
+        """
+    ]:
+        con.execute(sql)
+
+def m002_resumen(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS resumen_resultados (
+            clase_id INTEGER,
+            cuestionario TEXT,
+            resultado TEXT,
+            total INTEGER DEFAULT 0,
+            PRIMARY KEY (clase_id, cuestionario, resultado)
+        )
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS resumen_clases (
+            clase_id INTEGER PRIMARY KEY,
+            registrados INTEGER DEFAULT 0,
+            entregados INTEGER DEFAULT 0
+        )
+    """)
+
+def m003_indices(con):
+    for sql in [
+        "CREATE INDEX IF NOT EXISTS idx_resultados_estudiante ON resultados(estudiante_id, cuestionario)",
+        "CREATE INDEX IF NOT EXISTS idx_resultados_cuestionario ON resultados(cuestionario, estudiante_id)",
+        "CREATE INDEX IF NOT EXISTS idx_estudiantes_clase ON estudiantes(clase_id, nombre)",
+        "CREATE INDEX IF NOT EXISTS idx_estudiantes_nombre ON estudiantes(nombre)",
+        "CREATE INDEX IF NOT EXISTS idx_clase_cuestionarios_clase ON clase_cuestionarios(clase_id)",
+        "CREATE INDEX IF NOT EXISTS idx_resumen_cuestionario ON resumen_resultados(cuestionario, clase_id)",
+    ]:
+        con.execute(sql)
+
+def m004_nivel_salud(con):
+    columnas = {c["name"] for c in con.execute("PRAGMA table_info(resultados)")}
+    if "nivel" not in columnas:
+        con.execute("ALTER TABLE resultados ADD COLUMN nivel TEXT")
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_resultados_nivel ON resultados(cuestionario, nivel)"
+    )
+    # El relleno de nivel se hace en m013, ya con el esquema codificado
+
+def m005_indice_salud(con):
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_resultados_cuestionario_id ON resultados(cuestionario, id)"
+    )
+
+def m006_busqueda_estudiantes(con):
+    con.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS estudiantes_fts USING fts5(
+            nombre, carrera, matricula,
+            content='estudiantes',
+            content_rowid='id',
+            tokenize='trigram'
+        )
+    """)
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS estudiantes_fts_insert
+        AFTER INSERT ON estudiantes BEGIN
+            INSERT INTO estudiantes_fts (rowid, nombre, carrera, matricula)
+            VALUES (new.id, new.nombre, new.carrera, new.matricula);
+        END
+    """)
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS estudiantes_fts_delete
+        AFTER DELETE ON estudiantes BEGIN
+            INSERT INTO estudiantes_fts (estudiantes_fts, rowid, nombre, carrera, matricula)
+            VALUES ('delete', old.id, old.nombre, old.carrera, old.matricula);
+        END
+    """)
+    con.execute("""
+        CREATE TRIGGER IF NOT EXISTS estudiantes_fts_update
+        AFTER UPDATE ON estudiantes BEGIN
+            INSERT INTO estudiantes_fts (estudiantes_fts, rowid, nombre, carrera, matricula)
+            VALUES ('delete', old.id, old.nombre, old.carrera, old.matricula);
+            INSERT INTO estudiantes_fts (rowid, nombre, carrera, matricula)
+            VALUES (new.id, new.nombre, new.carrera, new.matricula);
+        END
+    """)
+    con.execute("INSERT INTO estudiantes_fts (estudiantes_fts) VALUES ('rebuild')")
+
+def m007_revocacion_sesiones(con):
+    columnas = {c["name"] for c in con.execute("PRAGMA table_info(sesiones)")}
+    if "revocada_en" not in columnas:
+        con.execute("ALTER TABLE sesiones ADD COLUMN revocada_en INTEGER")
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sesiones_revocada ON sesiones(revocada_en)"
+    )
+
+def m008_respuestas(con):
+    columnas = {c["name"] for c in con.execute("PRAGMA table_info(resultados)")}
+    if "respuestas" not in columnas:
+        con.execute("ALTER TABLE resultados ADD COLUMN respuestas TEXT")
+
+def m009_versiones_datos(con):
+    # clase_id 0 es la versión de toda la institución
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS versiones_datos (
+            clase_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    con.execute("""
+        INSERT OR IGNORE INTO versiones_datos (clase_id, version)
+        SELECT 0, 1 UNION ALL SELECT id, 1 FROM clases
+    """)
+
+def m010_clases_archivadas(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS clases_archivadas (
+            id INTEGER PRIMARY KEY,
+            nombre TEXT,
+            codigo TEXT,
+            archivo TEXT NOT NULL,
+            alumnos INTEGER,
+            resultados INTEGER,
+            bytes INTEGER,
+            archivada_en INTEGER
+        )
+    """)
+
+def m011_mantenimiento(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS clases_por_borrar (
+            clase_id INTEGER PRIMARY KEY,
+            pedida_en INTEGER
+        )
+    """)
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS idx_sesiones_creada ON sesiones(creada_en)"
+    )
+
+def m012_tendencias(con):
+    columnas = {c["name"] for c in con.execute("PRAGMA table_info(resultados)")}
+    if "creado_en" not in columnas:
+        con.execute("ALTER TABLE resultados ADD COLUMN creado_en INTEGER")
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS tendencias (
+            periodo TEXT,
+            inicio TEXT,
+            clase_id INTEGER,
+            cuestionario TEXT,
+            resultado TEXT,
+            total INTEGER DEFAULT 0,
+            PRIMARY KEY (periodo, cuestionario, clase_id, inicio, resultado)
+        )
+    """)
+
+def m013_codigos(con):
+    # Cuestionarios, familias (los cuestionarios de la lista de la clase) y
+    # etiquetas pasan a tablas de códigos; resultados, resumen_resultados y
+    # tendencias guardan solo los enteros. En resultados, "resultado" queda
+    # únicamente para el contenido cifrado de salud.
+    for sql in [
+        """
+        CREATE TABLE IF NOT EXISTS familias (
+            id INTEGER PRIMARY KEY,
+            nombre TEXT NOT NULL UNIQUE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS cuestionarios (
+            id INTEGER PRIMARY KEY,
+            nombre TEXT NOT NULL UNIQUE,
+            familia_id INTEGER REFERENCES familias(id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS etiquetas (
+            id INTEGER PRIMARY KEY,
+            nombre TEXT NOT NULL UNIQUE
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_cuestionarios_familia ON cuestionarios(familia_id)",
+    ]:
+        con.execute(sql)
+    sembrar_codigos(con)
+
+    etiqueta = """
+        CASE WHEN cuestionario = 'Cuestionario de Salud' THEN nivel ELSE resultado END
+    """
+    for tabla, columna_etiqueta in [
+        ("resultados", etiqueta),
+        ("tendencias", "resultado"),
+    ]:
+        # Nombres que ya no están en ESCALAS pero sí en los datos
+        con.execute(f"""
+            INSERT OR IGNORE INTO cuestionarios (nombre)
+            SELECT DISTINCT cuestionario FROM {tabla} WHERE cuestionario IS NOT NULL
+        """)
+        con.execute(f"""
+            INSERT OR IGNORE INTO etiquetas (nombre)
+            SELECT DISTINCT etiqueta FROM (SELECT {columna_etiqueta} AS etiqueta FROM {tabla})
+            WHERE etiqueta IS NOT NULL
+        """)
+
+    secuencia = con.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name='resultados'"
+    ).fetchone()
+    con.execute("""
+        CREATE TABLE resultados_codificados (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            estudiante_id INTEGER,
+            cuestionario_id INTEGER,
+            etiqueta_id INTEGER,
+            resultado TEXT,
+            respuestas TEXT,
+            creado_en INTEGER
+        )
+    """)
+    con.execute(f"""
+        INSERT INTO resultados_codificados
+        (id, estudiante_id, cuestionario_id, etiqueta_id, resultado, respuestas, creado_en)
+        SELECT r.id, r.estudiante_id, c.id, e.id,
+               CASE WHEN r.cuestionario = 'Cuestionario de Salud' THEN r.resultado END,
+               r.respuestas, r.creado_en
+        FROM (SELECT *, {etiqueta} AS etiqueta FROM resultados) r
+        LEFT JOIN cuestionarios c ON c.nombre = r.cuestionario
+        LEFT JOIN etiquetas e ON e.nombre = r.etiqueta
+    """)
+    con.execute("DROP TABLE resultados")
+    con.execute("ALTER TABLE resultados_codificados RENAME TO resultados")
+    if secuencia:
+        con.execute(
+            "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name='resultados'",
+            (secuencia[0],)
+        )
+
+    # El resumen se vuelve a llenar al final, desde resultados
+    con.execute("DROP TABLE resumen_resultados")
+    con.execute("""
+        CREATE TABLE resumen_resultados (
+            clase_id INTEGER,
+            cuestionario_id INTEGER,
+            etiqueta_id INTEGER,
+            total INTEGER DEFAULT 0,
+            PRIMARY KEY (clase_id, cuestionario_id, etiqueta_id)
+        )
+    """)
+
+    con.execute("""
+        CREATE TABLE tendencias_codificadas (
+            periodo TEXT,
+            inicio TEXT,
+            clase_id INTEGER,
+            cuestionario_id INTEGER,
+            etiqueta_id INTEGER,
+            total INTEGER DEFAULT 0,
+            PRIMARY KEY (periodo, cuestionario_id, clase_id, inicio, etiqueta_id)
+        )
+    """)
+    con.execute("""
+        INSERT INTO tendencias_codificadas
+        (periodo, inicio, clase_id, cuestionario_id, etiqueta_id, total)
+        SELECT t.periodo, t.inicio, t.clase_id, c.id, e.id, SUM(t.total)
+        FROM tendencias t
+        JOIN cuestionarios c ON c.nombre = t.cuestionario
+        JOIN etiquetas e ON e.nombre = t.resultado
+        GROUP BY t.periodo, t.inicio, t.clase_id, c.id, e.id
+    """)
+    con.execute("DROP TABLE tendencias")
+    con.execute("ALTER TABLE tendencias_codificadas RENAME TO tendencias")
+
+    for sql in [
+        "CREATE INDEX idx_resultados_estudiante ON resultados(estudiante_id, cuestionario_id)",
+        "CREATE INDEX idx_resultados_cuestionario ON resultados(cuestionario_id, estudiante_id)",
+        "CREATE INDEX idx_resultados_nivel ON resultados(cuestionario_id, etiqueta_id)",
+        "CREATE INDEX idx_resultados_cuestionario_id ON resultados(cuestionario_id, id)",
+        "CREATE INDEX idx_resumen_cuestionario ON resumen_resultados(cuestionario_id, clase_id)",
+    ]:
+        con.execute(sql)
+
+    # Registros de salud de antes de m004, con el nivel dentro del cifrado.
+    # El resumen viejo los contaba por su texto cifrado, así que se arma de
+    # nuevo desde resultados (las tendencias de clases archivadas ya se
+    # convirtieron arriba).
+    rellenar_nivel_salud(con)
+    reconstruir_resumen(con)
+
+def m014_tendencias_con_clase(con):
+    # Entregas de alumnos cuya clase ya no existía dejaron renglones con
+    # clase_id NULL; como NULL no choca en la llave primaria, cada entrega
+    # sumaba un renglón nuevo que luego contaba en la institución.
+    con.execute("""
+        CREATE TABLE tendencias_con_clase (
+            periodo TEXT,
+            inicio TEXT,
+            clase_id INTEGER NOT NULL,
+            cuestionario_id INTEGER,
+            etiqueta_id INTEGER,
+            total INTEGER DEFAULT 0,
+            PRIMARY KEY (periodo, cuestionario_id, clase_id, inicio, etiqueta_id)
+        )
+    """)
+    con.execute("""
+        INSERT INTO tendencias_con_clase
+        SELECT periodo, inicio, clase_id, cuestionario_id, etiqueta_id, total
+        FROM tendencias
+        WHERE clase_id IS NOT NULL
+    """)
+    con.execute("DROP TABLE tendencias")
+    con.execute("ALTER TABLE tendencias_con_clase RENAME TO tendencias")
+    con.execute("DELETE FROM resumen_resultados WHERE clase_id IS NULL")
+
+def m015_sin_indice_nombre(con):
+    # Ninguna consulta busca alumnos por nombre en toda la base (eso lo hace
+    # estudiantes_fts), pero con pocas clases el planificador recorría este
+    # índice completo para ahorrarse ordenar la página de alumnos.
+    con.execute("DROP INDEX IF EXISTS idx_estudiantes_nombre")
+
+# Solo se agregan pasos al final; la versión es la posición en la lista.
+MIGRACIONES = [
+    m001_esquema_base,
+    m002_resumen,
+    m003_indices,
+    m004_nivel_salud,
+    m005_indice_salud,
+    m006_busqueda_estudiantes,
+    m007_revocacion_sesiones,
+    m008_respuestas,
+    m009_versiones_datos,
+    m010_clases_archivadas,
+    m011_mantenimiento,
+    m012_tendencias,
+    m013_codigos,
+    m014_tendencias_con_clase,
+    m015_sin_indice_nombre,
+]
+
+# Migraciones que reescriben tablas grandes: el espacio liberado solo se
+# devuelve con un VACUUM, que no puede ir dentro de su transacción.
+VACUUM_DESPUES = {"m013_codigos"}
+
+def version_esquema(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            aplicada_en INTEGER
+        )
+    """)
+    return con.execute(
+        "SELECT IFNULL(MAX(version), 0) FROM schema_version"
+    ).fetchone()[0]
+
+def migrar(con):
+    if version_esquema(con) >= len(MIGRACIONES):
+        return []
+
+    # En una base nueva se activa el vacuum incremental; después de crear
+    # tablas ya solo se puede con un VACUUM completo (flask mantenimiento
+    # --activar-vacuum).
+    vacia = con.execute("""
+        SELECT NOT EXISTS (
+            SELECT 1 FROM sqlite_master
+            WHERE name NOT LIKE 'sqlite_%' AND name != 'schema_version'
+        )
+    """).fetchone()[0]
+    if vacia:
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        con.execute("VACUUM")
+
+    aplicadas = []
+    for version, migracion in enumerate(MIGRACIONES, start=1):
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            if version > version_esquema(con):
+                migracion(con)
+                con.execute(
+                    "INSERT INTO schema_version (version, aplicada_en) VALUES (?,?)",
+                    (version, int(time.time()))
+                )
+                aplicadas.append(migracion.__name__)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+
+    with con:
+        sin_resumen = con.execute(
+            "SELECT NOT EXISTS (SELECT 1 FROM resumen_clases)"
+        ).fetchone()[0]
+        hay_clases = con.execute(
+            "SELECT EXISTS (SELECT 1 FROM clases)"
+        ).fetchone()[0]
+
+        if sin_resumen and hay_clases:
+            reconstruir_resumen(con)
+
+    if not vacia and VACUUM_DESPUES.intersection(aplicadas):
+        con.execute("VACUUM")
+
+    return aplicadas
+
+app.config["MIGRAR_AL_INICIAR"] = os.environ.get("MIGRAR_AL_INICIAR", "0") == "1"
+
+def create_app():
+    # Punto de entrada de los workers (gunicorn "app:create_app()"). Importar
+    # el módulo no toca la base; el esquema se crea con "flask init-db" o
+    # "flask migrar" y aquí solo se comprueba, sin tomar el candado de escritura.
+    if not os.environ.get("FERNET_KEY"):
+        raise RuntimeError("FERNET_KEY no definida en variables de entorno")
+
+    if app.config["MIGRAR_AL_INICIAR"]:
+        with db() as con:
+            migrar(con)
+    else:
+        comprobar_esquema()
+
+    semilla()
+    if app.config["MANTENIMIENTO"]:
+        iniciar_mantenimiento()
+    return app
+
+def comprobar_esquema():
+    try:
+        con = sqlite3.connect(f"file:{DB}?mode=ro", uri=True)
+        try:
+            version = con.execute(
+                "SELECT IFNULL(MAX(version), 0) FROM schema_version"
+            ).fetchone()[0]
+        finally:
+            con.close()
+    except sqlite3.OperationalError:
+        version = 0
+
+    if version < len(MIGRACIONES):
+        raise RuntimeError(
+            f"La base está en la versión {version} de {len(MIGRACIONES)}; "
+            "ejecuta \"flask init-db\" antes de arrancar"
+        )
+
+@app.cli.command("rellenar-nivel-salud")
+def rellenar_nivel_salud_cmd():
+    with db() as con:
+        total = rellenar_nivel_salud(con, confirmar_lotes=True)
+        cambiar_todas_versiones(con)
+    print("Registros de salud actualizados:", total)
+
+def recalificar(con, nombre, lote=5000):
+    escala = ESCALAS[nombre]
+    salud = nombre == "Cuestionario de Salud"
+    ultimo_id = 0
+    revisados = cambiados = omitidos = 0
+
+    while True:
+        filas = con.execute("""
+            SELECT r.id, r.resultado, e.nombre AS etiqueta, r.respuestas
+            FROM resultados r
+            LEFT JOIN etiquetas e ON e.id = r.etiqueta_id
+            WHERE r.cuestionario_id=?
+            AND r.id > ?
+            ORDER BY r.id
+            LIMIT ?
+        """, (codigo(con, "cuestionarios", nombre), ultimo_id, lote)).fetchall()
+
+        if not filas:
+            break
+        ultimo_id = filas[-1]["id"]
+
+        ids, actuales, vectores = [], [], []
+        for fila in filas:
+            if salud:
+                nivel, respuestas = descifrar_salud(fila["etiqueta"], fila["resultado"])
+                vector = codificar(escala, respuestas) if respuestas else None
+                actual = nivel
             else:
-                con.execute("""
-                    UPDATE intentos_admin
-                    SET intentos=?
-                    WHERE ip=?
-                """, (intentos, ip))
+                vector = json.loads(fila["respuestas"]) if fila["respuestas"] else None
+                actual = fila["etiqueta"]
+
+            if vector is None or len(vector) != len(escala["items"]):
+                omitidos += 1
+                continue
+
+            ids.append(fila["id"])
+            actuales.append(actual)
+            vectores.append(vector)
+
+        cambios = [
+            (codigo(con, "etiquetas", nueva), id_)
+            for id_, actual, nueva in zip(ids, actuales, etiquetas_matriz(escala, vectores))
+            if nueva != actual
+        ]
+        con.executemany("UPDATE resultados SET etiqueta_id=? WHERE id=?", cambios)
+
+        revisados += len(ids)
+        cambiados += len(cambios)
+
+    return revisados, cambiados, omitidos
+
+@app.cli.command("recalificar")
+@click.argument("escalas", nargs=-1)
+def recalificar_cmd(escalas):
+    inicio = time.perf_counter()
+    with db() as con:
+        for nombre in escalas or ESCALAS:
+            revisados, cambiados, omitidos = recalificar(con, nombre)
+            print(f"{nombre}: {revisados} revisados, {cambiados} cambiados, {omitidos} sin respuestas")
+        reconstruir_resumen(con)
+    print(f"Listo en {time.perf_counter() - inicio:.1f}s")
+
+@app.cli.command("migrar")
+def migrar_cmd():
+    with db() as con:
+        aplicadas = migrar(con)
+        version = version_esquema(con)
+
+    for nombre in aplicadas:
+        print("Aplicada", nombre)
+    print("Esquema en versión", version)
+
+app.cli.add_command(migrar_cmd, "init-db")
+
+@app.cli.command("medir-arranque")
+@click.option("--veces", default=5, show_default=True)
+@click.option("--presupuesto-ms", type=float,
+              default=float(os.environ.get("ARRANQUE_PRESUPUESTO_MS", 400)), show_default=True)
+def medir_arranque_cmd(veces, presupuesto_ms):
+    # Cada corrida es un proceso nuevo, como un worker recién creado:
+    # mide importar el módulo y create_app(), sin el arranque del intérprete.
+    import subprocess
+    import sys
+
+    codigo = (
+        "import sys, time, json\n"
+        "inicio = time.perf_counter()\n"
+        f"sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})\n"
+        f"import {__name__} as modulo\n"
+        "modulo.create_app()\n"
+        "print(json.dumps({'ms': 1000 * (time.perf_counter() - inicio), "
+        "'pesados': [m for m in ('cryptography', 'bcrypt', 'dotenv', 'numpy', 'openpyxl') if m in sys.modules]}))\n"
+    )
+
+    tiempos, pesados = [], set()
+    for _ in range(veces):
+        salida = subprocess.run(
+            [sys.executable, "-c", codigo],
+            capture_output=True, text=True
+        )
+        if salida.returncode != 0:
+            raise click.ClickException(salida.stderr.strip().splitlines()[-1])
+        medida = json.loads(salida.stdout.strip().splitlines()[-1])
+        tiempos.append(medida["ms"])
+        pesados.update(medida["pesados"])
+
+    tiempos.sort()
+    mediana = tiempos[len(tiempos) // 2]
+    print(f"Arranque en frío: mediana {mediana:.0f} ms, mínimo {tiempos[0]:.0f} ms, "
+          f"máximo {tiempos[-1]:.0f} ms (presupuesto {presupuesto_ms:.0f} ms)")
+    if pesados:
+        print("Módulos cargados al arrancar:", ", ".join(sorted(pesados)))
+
+    if mediana > presupuesto_ms:
+        raise SystemExit(1)
+
+@app.cli.command("reconstruir-resumen")
+def reconstruir_resumen_cmd():
+    with db() as con:
+        reconstruir_resumen(con)
+    print("Resumen reconstruido")
+
+class ClienteCarga:
+    # El mismo recorrido sirve contra el cliente de pruebas de Flask o
+    # contra un servidor local (--url); las redirecciones no se siguen
+    # para poder medir cada ruta por separado.
+    def __init__(self, url=None):
+        self.url = url
+
+        if not url:
+            self.cliente = app.test_client()
+            return
+
+        import http.cookiejar
+        import urllib.request
+
+        class SinRedirecciones(urllib.request.HTTPRedirectHandler):
+            def redirect_request(self, *args, **kwargs):
+                return None
+
+        self.urllib = urllib
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            SinRedirecciones()
+        )
+
+    def pedir(self, metodo, ruta, datos=None):
+        if not self.url:
+            r = self.cliente.open(ruta, method=metodo, data=datos)
+            return r.status_code, r.headers.get("Location", ""), r.get_data(as_text=True)
+
+        import urllib.error
+        import urllib.parse
+
+        cuerpo = urllib.parse.urlencode(datos, doseq=True).encode() if datos is not None else None
+        peticion = self.urllib.request.Request(self.url + ruta, data=cuerpo, method=metodo)
+        try:
+            with self.opener.open(peticion) as r:
+                return r.status, r.headers.get("Location", ""), r.read().decode()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.get("Location", ""), e.read().decode()
+
+def respuestas_aleatorias(ruta, azar):
+    cuestionario = next(c for c, r in RUTAS_CUESTIONARIOS.items() if r == ruta)
+    respuestas = {}
+    for nombre in CUESTIONARIOS[cuestionario]:
+        for item in ESCALAS[nombre]["items"]:
+            respuestas[item] = azar.choice(ESCALAS[nombre]["opciones"])
+    return respuestas
+
+def percentil(ordenados, p):
+    if not ordenados:
+        return None
+    return ordenados[min(len(ordenados) - 1, int(p / 100 * len(ordenados)))]
+
+class PruebaCarga:
+    def __init__(self, url, cuestionarios, semilla):
+        self.url = url
+        self.cuestionarios = cuestionarios
+        self.semilla = semilla
+        self.lock = threading.Lock()
+        self.tiempos = {}
+        self.ocupado = 0
+        self.errores = []
+        self.alumnos_terminados = 0
+
+    def medir(self, cliente, etiqueta, metodo, ruta, datos=None):
+        inicio = time.perf_counter()
+        try:
+            estado, destino, cuerpo = cliente.pedir(metodo, ruta, datos)
+        except sqlite3.OperationalError as e:
+            with self.lock:
+                if "locked" in str(e) or "busy" in str(e):
+                    self.ocupado += 1
+                self.errores.append(f"{etiqueta}: {e}")
+            raise
+
+        with self.lock:
+            self.tiempos.setdefault(etiqueta, []).append(time.perf_counter() - inicio)
+            if estado >= 500:
+                if estado == 503:
+                    self.ocupado += 1
+                self.errores.append(f"{etiqueta}: HTTP {estado}")
+
+        if estado >= 400:
+            raise RuntimeError(f"{etiqueta}: HTTP {estado}")
+        return destino, cuerpo
+
+    def admin(self, usuario, password):
+        cliente = ClienteCarga(self.url)
+        if self.url:
+            destino, _ = self.medir(cliente, "POST /orientacion", "POST", "/orientacion",
+                                    {"u": usuario, "p": password})
+            if "/dashboard" not in destino:
+                raise click.ClickException("No se pudo iniciar sesión como administrador")
         else:
-            con.execute("""
-                INSERT INTO intentos_admin (ip, intentos)
-                VALUES (?, 1)
-            """, (ip,))
-
-with db() as con:
-    con.executescript("""
-    CREATE TABLE IF NOT EXISTS clases(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        nombre TEXT,
-        codigo TEXT UNIQUE
-    );
-
-    CREATE TABLE IF NOT EXISTS clase_cuestionarios(
-        clase_id INTEGER,
-        cuestionario TEXT
-    );
-
-    CREATE TABLE IF NOT EXISTS estudiantes(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        nombre TEXT,
-        matricula TEXT,
-        grupo TEXT,
-        carrera TEXT NOT NULL,
-        clase_id INTEGER
-    );
-
-    CREATE TABLE IF NOT EXISTS resultados(
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        estudiante_id INTEGER,
-        cuestionario TEXT,
-        resultado TEXT
-    );
-
-    CREATE TABLE IF NOT EXISTS intentos_admin (
-        ip TEXT PRIMARY KEY,
-        intentos INTEGER DEFAULT 0,
-        bloqueado_hasta INTEGER
-    );
-                      
-    CREATE TABLE IF NOT EXISTS sesiones (
-        estudiante_id INTEGER PRIMARY KEY,
-        token TEXT NOT NULL,
-        user_agent TEXT,
-        creada_en INTEGER DEFAULT (strftime('%s','now')),
-        FOREIGN KEY(estudiante_id) REFERENCES estudiantes(id)
-    );
-    """)
+            with cliente.cliente.session_transaction() as s:
+                s["admin"] = True
+        return cliente
+
+    def crear_clase(self, cliente):
+        nombre = f"Carga {uuid.uuid4().hex[:8]}"
+        _, cuerpo = self.medir(cliente, "POST /dashboard", "POST", "/dashboard",
+                               {"nombre": nombre, "cuestionarios": self.cuestionarios})
+        codigos = re.findall(r"/c/([0-9A-F]{6})", cuerpo)
+        if not codigos:
+            raise click.ClickException("El dashboard no devolvió el código de la clase")
+        return codigos[-1]
+
+    def alumno(self, codigo, numero):
+        azar = random.Random(f"{self.semilla}:{numero}")
+        cliente = ClienteCarga(self.url)
+
+        _, cuerpo = self.medir(cliente, "GET /c/<codigo>", "GET", f"/c/{codigo}")
+        clase_id = re.search(r'name="clase_id" value="(\d+)"', cuerpo).group(1)
+
+        destino, _ = self.medir(cliente, "POST /registro", "POST", "/registro", {
+            "nombre": f"Alumno carga {numero}",
+            "matricula": f"C{numero:06d}",
+            "carrera": "Carga",
+            "clase_id": clase_id
+        })
+
+        while "/final" not in destino:
+            ruta = destino.rsplit("/", 1)[-1]
+            self.medir(cliente, f"GET /{ruta}", "GET", f"/{ruta}")
+            destino, _ = self.medir(cliente, f"POST /{ruta}", "POST", f"/{ruta}",
+                                    respuestas_aleatorias(ruta, azar))
+
+        self.medir(cliente, "GET /final", "GET", "/final")
+        with self.lock:
+            self.alumnos_terminados += 1
+
+    def recargar_dashboard(self, cliente, clase_id, terminado, pausa):
+        while not terminado.is_set():
+            try:
+                self.medir(cliente, "GET /dashboard?clase_id", "GET", f"/dashboard?clase_id={clase_id}")
+            except Exception:
+                pass
+            terminado.wait(pausa)
+
+    def correr(self, alumnos, concurrencia, admins, usuario, password, pausa):
+        primero = self.admin(usuario, password)
+        codigo = self.crear_clase(primero)
+        _, _, cuerpo = ClienteCarga(self.url).pedir("GET", f"/c/{codigo}")
+        clase_id = re.search(r'name="clase_id" value="(\d+)"', cuerpo).group(1)
+
+        terminado = threading.Event()
+        recargas = [
+            threading.Thread(
+                target=self.recargar_dashboard,
+                args=(primero if i == 0 else self.admin(usuario, password), clase_id, terminado, pausa),
+                daemon=True
+            )
+            for i in range(admins)
+        ]
+
+        inicio = time.perf_counter()
+        for hilo in recargas:
+            hilo.start()
+
+        with ThreadPoolExecutor(max_workers=concurrencia) as ejecutor:
+            for futuro in [ejecutor.submit(self.alumno, codigo, n) for n in range(alumnos)]:
+                try:
+                    futuro.result()
+                except Exception:
+                    pass
+
+        duracion = time.perf_counter() - inicio
+        terminado.set()
+        for hilo in recargas:
+            hilo.join()
+
+        return self.reporte(alumnos, concurrencia, admins, clase_id, duracion)
+
+    def reporte(self, alumnos, concurrencia, admins, clase_id, duracion):
+        peticiones = sum(len(t) for t in self.tiempos.values())
+        rutas = {}
+        for etiqueta, tiempos in sorted(self.tiempos.items()):
+            ordenados = sorted(tiempos)
+            rutas[etiqueta] = {
+                "peticiones": len(ordenados),
+                "p50_ms": round(1000 * percentil(ordenados, 50), 2),
+                "p95_ms": round(1000 * percentil(ordenados, 95), 2),
+                "p99_ms": round(1000 * percentil(ordenados, 99), 2),
+                "max_ms": round(1000 * ordenados[-1], 2)
+            }
+
+        return {
+            "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "destino": self.url or "test_client",
+            "alumnos": alumnos,
+            "concurrencia": concurrencia,
+            "admins": admins,
+            "cuestionarios": self.cuestionarios,
+            "clase_id": int(clase_id),
+            "alumnos_terminados": self.alumnos_terminados,
+            "duracion_s": round(duracion, 3),
+            "peticiones": peticiones,
+            "peticiones_por_s": round(peticiones / duracion, 2) if duracion else None,
+            "alumnos_por_s": round(self.alumnos_terminados / duracion, 2) if duracion else None,
+            "ocupado": self.ocupado,
+            "errores": len(self.errores),
+            "muestra_errores": self.errores[:10],
+            "rutas": rutas
+        }
+
+@app.cli.command("prueba-carga")
+@click.option("--alumnos", default=50, show_default=True, help="Alumnos que contestan la batería")
+@click.option("--concurrencia", default=10, show_default=True, help="Alumnos contestando a la vez")
+@click.option("--admins", default=2, show_default=True, help="Administradores recargando el dashboard")
+@click.option("--pausa", default=0.5, show_default=True, help="Segundos entre recargas del dashboard")
+@click.option("--cuestionario", "cuestionarios", multiple=True,
+              type=click.Choice(list(RUTAS_CUESTIONARIOS)), help="Plan de la clase (por omisión, todos)")
+@click.option("--url", default=None, help="Servidor local, p. ej. http://127.0.0.1:5000 (por omisión, test client)")
+@click.option("--usuario", envvar="ADMIN_USER", help="Usuario administrador (solo con --url)")
+@click.option("--password", envvar="CARGA_ADMIN_PASS", help="Contraseña del administrador (solo con --url)")
+@click.option("--semilla", default=0, show_default=True)
+@click.option("--salida", type=click.Path(dir_okay=False), help="Archivo JSON para comparar corridas")
+def prueba_carga_cmd(alumnos, concurrencia, admins, pausa, cuestionarios, url, usuario, password, semilla, salida):
+    if url and not (usuario and password):
+        raise click.UsageError("Con --url hacen falta --usuario y --password")
+
+    if not url:
+        create_app()
+
+    # Con el test client las excepciones de SQLite llegan al hilo que hizo
+    # la petición y se pueden contar como "ocupado".
+    app.config["PROPAGATE_EXCEPTIONS"] = True
+    prueba = PruebaCarga(url.rstrip("/") if url else None, list(cuestionarios or RUTAS_CUESTIONARIOS), semilla)
+    reporte = prueba.correr(alumnos, concurrencia, admins, usuario, password, pausa)
+
+    for etiqueta, datos in reporte["rutas"].items():
+        print(f"{etiqueta:28} n={datos['peticiones']:<6} p50={datos['p50_ms']:>8} "
+              f"p95={datos['p95_ms']:>8} p99={datos['p99_ms']:>8} ms")
+    print(f"{reporte['alumnos_terminados']}/{alumnos} alumnos en {reporte['duracion_s']} s, "
+          f"{reporte['peticiones_por_s']} peticiones/s, ocupado={reporte['ocupado']}, "
+          f"errores={reporte['errores']}")
+
+    if salida:
+        with open(salida, "w", encoding="utf-8") as archivo:
+            json.dump(reporte, archivo, ensure_ascii=False, indent=2)
 
 @app.route("/")
 def inicio():
@@ -141,10 +2126,16 @@ def login():
         admin_user = os.getenv("ADMIN_USER")
         admin_hash = os.getenv("ADMIN_PASS_HASH")
 
-        if u == admin_user and bcrypt.checkpw(p.encode(), admin_hash.encode()):
-            limpiar_intentos(ip)
-            session["admin"] = True
-            return redirect("/dashboard")
+        if u == admin_user:
+            valido = verificar_password(p, admin_hash)
+
+            if valido is None:
+                return "Servidor ocupado. Intenta más tarde.", 503
+
+            if valido:
+                limpiar_intentos(ip)
+                session["admin"] = True
+                return redirect("/dashboard")
 
         registrar_fallo(ip)
         return "Credenciales incorrectas"
@@ -152,21 +2143,514 @@ def login():
     return render_template("login.html")
 
 def limpiar_intentos(ip):
-    with db() as con:
-        con.execute("DELETE FROM intentos_admin WHERE ip=?", (ip,))
+    limitador_intentos().limpiar(ip)
 
 @app.route("/logout")
 def logout():
+    if session.get("admin"):
+        detalles_salud.vaciar()
     session.clear()
     return redirect("/orientacion")
 
+CONSULTA_ESTADISTICAS_CLASE = """
+    SELECT cuestionarios.nombre AS cuestionario,
+           etiquetas.nombre AS resultado,
+           resumen.total,
+           IFNULL(clase.entregados, 0) AS entregados,
+           ROUND(100.0 * resumen.total / NULLIF(clase.entregados, 0), 1) AS porcentaje,
+           ROUND(
+               100.0 * resumen.total /
+               SUM(resumen.total) OVER (PARTITION BY resumen.cuestionario_id), 1
+           ) AS porcentaje_cuestionario
+    FROM clases
+    LEFT JOIN resumen_clases clase ON clase.clase_id = clases.id
+    LEFT JOIN resumen_resultados resumen ON resumen.clase_id = clases.id
+    LEFT JOIN cuestionarios ON cuestionarios.id = resumen.cuestionario_id
+    LEFT JOIN etiquetas ON etiquetas.id = resumen.etiqueta_id
+    WHERE clases.id = ?
+    ORDER BY cuestionarios.nombre, etiquetas.nombre
+"""
+
+def estadisticas_clase(con, clase_id):
+    # Todas las distribuciones del grupo en una sola lectura del resumen.
+    # Los porcentajes son sobre alumnos con entregas, salvo estilos, que
+    # se reparte sobre quienes contestaron ese cuestionario.
+    filas = con.execute(CONSULTA_ESTADISTICAS_CLASE, (clase_id,)).fetchall()
+    if not filas:
+        return None
+
+    stats = {
+        "total": filas[0]["entregados"],
+        "estilos": [],
+        "autoestima": [],
+        "habilidades": [],
+        "tamizaje": {nombre: [] for nombre in CUESTIONARIOS["Batería de Tamizaje"]},
+        "salud": []
+    }
+    secciones = {
+        "Estilos de aprendizaje": stats["estilos"],
+        "Autoestima Rosenberg": stats["autoestima"],
+        "Habilidades": stats["habilidades"],
+        "Cuestionario de Salud": stats["salud"],
+        **stats["tamizaje"]
+    }
+
+    for fila in filas:
+        seccion = secciones.get(fila["cuestionario"])
+        if seccion is None:
+            continue
+        seccion.append({
+            "resultado": fila["resultado"],
+            "total": fila["total"],
+            "porcentaje": fila[
+                "porcentaje_cuestionario"
+                if fila["cuestionario"] == "Estilos de aprendizaje"
+                else "porcentaje"
+            ]
+        })
+
+    return stats
+
+@app.route("/api/clase/<int:clase_id>/stats")
+def api_estadisticas_clase(clase_id):
+    if not session.get("admin"):
+        return redirect("/orientacion")
+
+    with db() as con:
+        stats = estadisticas_clase(con, clase_id)
+
+    if stats is None:
+        return {"error": "Clase no encontrada"}, 404
+
+    return dict(stats, clase_id=clase_id)
+
+def semilla_etag():
+    # Huella de app.py, plantillas y estáticos: desplegar un cambio en
+    # cualquiera de ellos cambia la semilla aunque app.py no se toque.
+    archivos = [os.path.abspath(__file__)]
+    for carpeta in (os.path.join(app.root_path, app.template_folder), app.static_folder):
+        for raiz, _, nombres in os.walk(carpeta):
+            archivos += [os.path.join(raiz, nombre) for nombre in nombres]
+
+    huella = hashlib.sha1()
+    for ruta in sorted(archivos):
+        try:
+            estado = os.stat(ruta)
+        except OSError:
+            continue
+        huella.update(f"{ruta}:{estado.st_mtime_ns}:{estado.st_size}\n".encode())
+    return huella.hexdigest()[:12]
+
+# La semilla cambia con cada despliegue para que un ETag viejo no
+# valide una página generada por otra versión del código. ETAG_SEMILLA
+# permite fijarla, p. ej. con la versión que se despliega. Se calcula al
+# primer uso (o en create_app) para que importar no recorra el disco.
+app.config.setdefault("ETAG_SEMILLA", os.environ.get("ETAG_SEMILLA"))
+
+def semilla():
+    if not app.config["ETAG_SEMILLA"]:
+        app.config["ETAG_SEMILLA"] = semilla_etag()
+    return app.config["ETAG_SEMILLA"]
+
+def etiqueta_datos(*partes):
+    return "-".join(str(p) for p in (semilla(),) + partes)
+
+def con_etiqueta(respuesta, etiqueta):
+    respuesta.set_etag(etiqueta)
+    respuesta.cache_control.private = True
+    respuesta.cache_control.no_cache = True
+    return respuesta
+
+def sin_cambios(etiqueta):
+    if etiqueta in request.if_none_match:
+        return con_etiqueta(Response(status=304), etiqueta)
+    return None
+
+CONSULTA_TENDENCIA = """
+    SELECT t.inicio, etiquetas.nombre AS resultado, SUM(t.total) AS total
+    FROM tendencias t
+    JOIN etiquetas ON etiquetas.id = t.etiqueta_id
+    WHERE {condiciones}
+    GROUP BY t.inicio, t.etiqueta_id
+    ORDER BY t.inicio
+"""
+
+def tendencia(con, periodo, cuestionario, clase_id=None, desde=None, hasta=None):
+    # Solo lee tendencias: el costo depende del número de periodos, no de
+    # cuántas entregas hay en resultados.
+    condiciones = [
+        "t.periodo=?",
+        "t.cuestionario_id = (SELECT id FROM cuestionarios WHERE nombre=?)"
+    ]
+    params = [periodo, cuestionario]
+    if clase_id is not None:
+        condiciones.append("t.clase_id=?")
+        params.append(clase_id)
+    if desde:
+        condiciones.append("t.inicio >= ?")
+        params.append(desde)
+    if hasta:
+        condiciones.append("t.inicio <= ?")
+        params.append(hasta)
+
+    puntos = OrderedDict()
+    consulta = CONSULTA_TENDENCIA.format(condiciones=" AND ".join(condiciones))
+    for fila in con.execute(consulta, params):
+        punto = puntos.setdefault(fila["inicio"], {"inicio": fila["inicio"], "total": 0, "resultados": {}})
+        punto["resultados"][fila["resultado"]] = fila["total"]
+        punto["total"] += fila["total"]
+    return list(puntos.values())
+
+def filtros_tendencia():
+    periodo = request.args.get("periodo", "semana")
+    cuestionario = request.args.get("cuestionario", "Autoestima Rosenberg")
+    if periodo not in PERIODOS_TENDENCIA or cuestionario not in ESCALAS:
+        return None
+    return {
+        "periodo": periodo,
+        "cuestionario": cuestionario,
+        "clase_id": request.args.get("clase_id", type=int),
+        "desde": request.args.get("desde") or None,
+        "hasta": request.args.get("hasta") or None
+    }
+
+@app.route("/api/tendencias")
+def api_tendencias():
+    if not session.get("admin"):
+        return redirect("/orientacion")
+
+    filtros = filtros_tendencia()
+    if filtros is None:
+        return {"error": "Periodo o cuestionario no válido"}, 400
+
+    with db() as con:
+        etiqueta = etiqueta_datos("tendencias", version_datos(con))
+        respuesta = sin_cambios(etiqueta)
+        if respuesta:
+            return respuesta
+        puntos = tendencia(con, **filtros)
+
+    return con_etiqueta(make_response(dict(filtros, puntos=puntos)), etiqueta)
+
+@app.route("/tendencias")
+def tendencias():
+    if not session.get("admin"):
+        return redirect("/orientacion")
+
+    filtros = filtros_tendencia()
+    if filtros is None:
+        return redirect("/tendencias")
+
+    with db() as con:
+        etiqueta = etiqueta_datos("tendencias", version_datos(con))
+        respuesta = sin_cambios(etiqueta)
+        if respuesta:
+            return respuesta
+
+        puntos = tendencia(con, **filtros)
+        clases = con.execute("""
+            SELECT id, nombre FROM clases
+            UNION ALL
+            SELECT id, nombre FROM clases_archivadas
+            ORDER BY nombre
+        """).fetchall()
+
+    # Columnas en el orden de la escala; las etiquetas viejas que ya no
+    # estén en ella van al final.
+    etiquetas = list(ESCALAS[filtros["cuestionario"]].get("etiquetas", []))
+    for punto in puntos:
+        for resultado in punto["resultados"]:
+            if resultado not in etiquetas:
+                etiquetas.append(resultado)
+
+    return con_etiqueta(make_response(render_template(
+        "tendencias.html",
+        puntos=puntos,
+        etiquetas=etiquetas,
+        clases=clases,
+        escalas=list(ESCALAS),
+        periodos=PERIODOS_TENDENCIA,
+        **filtros
+    )), etiqueta)
+
+app.config.update(
+    CACHE_FRAGMENTOS=int(os.environ.get("CACHE_FRAGMENTOS", 256)),
+    CACHE_FRAGMENTOS_DIR=os.environ.get("CACHE_FRAGMENTOS_DIR"),
+    CACHE_FRAGMENTOS_DISCO_MAX=2000
+)
+
+class CacheFragmentos:
+    # HTML ya renderizado de cada sección del dashboard. La clave lleva la
+    # versión de datos, así que nunca hay que invalidar: las entradas viejas
+    # simplemente dejan de pedirse y salen por LRU (o por antigüedad en disco).
+    def __init__(self, maximo, directorio=None, maximo_disco=2000):
+        self.memoria = CacheLRU(maximo)
+        self.directorio = directorio
+        self.maximo_disco = maximo_disco
+        self.lock = threading.Lock()
+        self.contadores = {}
+        self.escrituras = 0
+
+    def contar(self, seccion, tipo):
+        with self.lock:
+            contador = self.contadores.setdefault(seccion, {"memoria": 0, "disco": 0, "fallos": 0})
+            contador[tipo] += 1
+
+    def archivo(self, clave):
+        return os.path.join(
+            self.directorio,
+            hashlib.sha1(repr(clave).encode()).hexdigest() + ".html"
+        )
+
+    def leer_disco(self, clave):
+        try:
+            with open(self.archivo(clave), encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def guardar_disco(self, clave, html):
+        destino = self.archivo(clave)
+        temporal = f"{destino}.{threading.get_ident()}.tmp"
+        try:
+            # La carpeta se crea con la primera escritura, no al importar
+            os.makedirs(self.directorio, exist_ok=True)
+            with open(temporal, "w", encoding="utf-8") as f:
+                f.write(html)
+            os.replace(temporal, destino)
+        except OSError:
+            return
+
+        with self.lock:
+            self.escrituras += 1
+            podar = self.escrituras % 100 == 0
+        if podar:
+            self.podar_disco()
+
+    def podar_disco(self):
+        archivos = []
+        for entrada in os.scandir(self.directorio):
+            if entrada.name.endswith(".html"):
+                try:
+                    archivos.append((entrada.stat().st_mtime, entrada.path))
+                except OSError:
+                    pass
+        archivos.sort()
+        for _, ruta in archivos[:max(0, len(archivos) - self.maximo_disco)]:
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+    def obtener(self, seccion, clave, generar):
+        clave = (seccion,) + clave
+        html = self.memoria.get(clave)
+        if html is not None:
+            self.contar(seccion, "memoria")
+            return Markup(html)
+
+        if self.directorio:
+            html = self.leer_disco(clave)
+            if html is not None:
+                self.memoria.put(clave, html)
+                self.contar(seccion, "disco")
+                return Markup(html)
+
+        self.contar(seccion, "fallos")
+        html = str(generar())
+        self.memoria.put(clave, html)
+        if self.directorio:
+            self.guardar_disco(clave, html)
+        return Markup(html)
+
+    def estado(self):
+        with self.lock:
+            secciones = {nombre: dict(c) for nombre, c in self.contadores.items()}
+        for c in secciones.values():
+            total = c["memoria"] + c["disco"] + c["fallos"]
+            c["aciertos_pct"] = round(100 * (c["memoria"] + c["disco"]) / total, 1) if total else 0
+        return {
+            "entradas": len(self.memoria.datos),
+            "maximo": self.memoria.maximo,
+            "disco": self.directorio,
+            "secciones": secciones
+        }
+
+fragmentos_dashboard = CacheFragmentos(
+    app.config["CACHE_FRAGMENTOS"],
+    app.config["CACHE_FRAGMENTOS_DIR"],
+    app.config["CACHE_FRAGMENTOS_DISCO_MAX"]
+)
+
+# Las secciones del dashboard muestran todas las clases: recorrer clases
+# completa es lo esperado (hay una fila por grupo) y el resumen se busca
+# por su llave primaria desde cada clase.
+CONSULTA_ENTREGAS = """
+    SELECT clases.nombre,
+        IFNULL(resumen.registrados, 0) AS registrados,
+        IFNULL(resumen.entregados, 0) AS entregados
+    FROM clases
+    LEFT JOIN resumen_clases resumen ON resumen.clase_id = clases.id
+"""
+
+CONSULTA_AUTOESTIMA_BAJA = """
+    SELECT clases.nombre,
+           ROUND(
+               100.0 * SUM(
+                   CASE WHEN resumen.etiqueta_id =
+                       (SELECT id FROM etiquetas WHERE nombre = 'Autoestima Baja')
+                   THEN resumen.total ELSE 0 END
+               ) / SUM(resumen.total), 1
+           ) AS porcentaje_baja
+    FROM resumen_resultados resumen
+    JOIN clases ON clases.id = resumen.clase_id
+    WHERE resumen.cuestionario_id =
+        (SELECT id FROM cuestionarios WHERE nombre = 'Autoestima Rosenberg')
+    GROUP BY clases.nombre
+"""
+
+# Aquí se recorre el resumen en lugar de clases: tiene a lo más un renglón
+# por clase, cuestionario y etiqueta, y cuatro de los cuestionarios son del
+# tamizaje.
+CONSULTA_TAMIZAJE_RIESGO = """
+    SELECT DISTINCT clases.nombre, etiquetas.nombre AS resultado
+    FROM resumen_resultados resumen
+    JOIN clases ON clases.id = resumen.clase_id
+    JOIN etiquetas ON etiquetas.id = resumen.etiqueta_id
+    WHERE resumen.cuestionario_id IN (
+        SELECT id FROM cuestionarios WHERE familia_id =
+            (SELECT id FROM familias WHERE nombre = 'Batería de Tamizaje')
+    )
+    AND resumen.etiqueta_id IN (
+        SELECT id FROM etiquetas
+        WHERE nombre IN ('Requiere evaluación','Consumo de riesgo','Elevado','Moderado')
+    )
+    AND resumen.total > 0
+"""
+
+CONSULTA_SALUD_RIESGO = """
+    SELECT clases.nombre,
+        ROUND(
+            100.0 * SUM(
+                CASE WHEN resumen.etiqueta_id IN (
+                    SELECT id FROM etiquetas WHERE nombre IN ('Riesgo moderado','Riesgo alto')
+                )
+                THEN resumen.total ELSE 0 END
+            ) / SUM(resumen.total),1
+        ) porcentaje
+    FROM resumen_resultados resumen
+    JOIN clases ON clases.id = resumen.clase_id
+    WHERE resumen.cuestionario_id =
+        (SELECT id FROM cuestionarios WHERE nombre = 'Cuestionario de Salud')
+    GROUP BY clases.nombre
+"""
+
+def seccion_entregas(con):
+    return render_template(
+        "dashboard_entregas.html",
+        entregas=con.execute(CONSULTA_ENTREGAS).fetchall()
+    )
+
+def seccion_autoestima(con):
+    return render_template(
+        "dashboard_autoestima.html",
+        autoestima_riesgo=con.execute(CONSULTA_AUTOESTIMA_BAJA).fetchall()
+    )
+
+def seccion_tamizaje(con):
+    return render_template(
+        "dashboard_tamizaje.html",
+        tamizaje=con.execute(CONSULTA_TAMIZAJE_RIESGO).fetchall()
+    )
+
+def seccion_salud(con):
+    return render_template(
+        "dashboard_salud.html",
+        salud_riesgo=con.execute(CONSULTA_SALUD_RIESGO).fetchall()
+    )
+
+def seccion_clases(con):
+    return render_template(
+        "dashboard_clases.html",
+        clases=con.execute("SELECT * FROM clases").fetchall(),
+        archivadas=con.execute(
+            "SELECT *, date(archivada_en, 'unixepoch') AS fecha FROM clases_archivadas ORDER BY archivada_en DESC"
+        ).fetchall()
+    )
+
+def seccion_selector(con, clase_seleccionada):
+    return render_template(
+        "dashboard_selector.html",
+        clases=con.execute("SELECT id, nombre FROM clases").fetchall(),
+        clase_seleccionada=clase_seleccionada
+    )
+
+def seccion_grupo(con, clase_id):
+    return render_template(
+        "dashboard_grupo.html",
+        stats_grupo=estadisticas_clase(con, clase_id)
+    )
+
+# Cada sección se guarda con las versiones de las clases que muestra, así
+# una entrega solo regenera las secciones donde aparece su clase: las de
+# una familia de cuestionarios cubren las clases con esos resultados en el
+# resumen; la lista de clases solo cambia al crear, archivar o eliminar.
+# Igual que las secciones, recorren clases o versiones_datos completas (un
+# renglón por clase).
+VERSIONES_CLASES_FAMILIA = """
+    SELECT v.clase_id, v.version
+    FROM versiones_datos v
+    WHERE v.clase_id IN (
+        SELECT resumen.clase_id
+        FROM resumen_resultados resumen
+        WHERE resumen.cuestionario_id IN (
+            SELECT id FROM cuestionarios WHERE familia_id =
+                (SELECT id FROM familias WHERE nombre=?)
+        )
+    )
+    ORDER BY v.clase_id
+"""
+
+VERSIONES_CLASES_VIVAS = """
+    SELECT clases.id, v.version
+    FROM clases
+    LEFT JOIN versiones_datos v ON v.clase_id = clases.id
+    ORDER BY clases.id
+"""
+
+LISTA_CLASES = """
+    SELECT id FROM clases
+    UNION ALL
+    SELECT -id FROM clases_archivadas
+    ORDER BY 1
+"""
+
+SECCIONES_DASHBOARD = {
+    "entregas": (seccion_entregas, VERSIONES_CLASES_VIVAS, ()),
+    "autoestima": (seccion_autoestima, VERSIONES_CLASES_FAMILIA, ("Autoestima Rosenberg",)),
+    "tamizaje": (seccion_tamizaje, VERSIONES_CLASES_FAMILIA, ("Batería de Tamizaje",)),
+    "salud": (seccion_salud, VERSIONES_CLASES_FAMILIA, ("Cuestionario de Salud",)),
+    "clases": (seccion_clases, LISTA_CLASES, ())
+}
+
+def version_seccion(con, sql, params):
+    filas = [tuple(fila) for fila in con.execute(sql, params)]
+    return hashlib.sha1(repr(filas).encode()).hexdigest()
+
+@app.route("/api/fragmentos")
+def estado_fragmentos():
+    if not session.get("admin"):
+        return redirect("/orientacion")
+
+    return fragmentos_dashboard.estado()
+
 @app.route("/dashboard", methods=["GET","POST"])
 def dashboard():
     if not session.get("admin"):
         return redirect("/orientacion")
     
     clase_seleccionada = request.args.get("clase_id")
-    stats_grupo = None
+    etiqueta = None
 
     with db() as con:
 
@@ -189,393 +2673,1195 @@ def dashboard():
                     (clase_id, c)
                 )
 
-        clases = con.execute(
-            "SELECT * FROM clases"
-        ).fetchall()
+            con.execute(
+                "INSERT INTO resumen_clases (clase_id) VALUES (?)",
+                (clase_id,)
+            )
+            cambiar_version(con, clase_id)
+            con.commit()
+
+            olvidar_clase(clase_id)
+
+        version = version_datos(con)
+
+        if request.method == "GET":
+            etiqueta = etiqueta_datos("dashboard", version, clase_seleccionada or "")
+            respuesta = sin_cambios(etiqueta)
+            if respuesta:
+                return respuesta
+
+        # Las versiones se leen antes que los datos: en el peor caso una
+        # sección queda guardada con datos más nuevos que su clave, nunca más
+        # viejos. Los enlaces absolutos de "clases" dependen del host.
+        clave = (semilla(), request.host_url)
+        fragmentos = {
+            nombre: fragmentos_dashboard.obtener(
+                nombre, clave + (version_seccion(con, sql, params),),
+                lambda seccion=seccion: seccion(con)
+            )
+            for nombre, (seccion, sql, params) in SECCIONES_DASHBOARD.items()
+        }
 
-        resultados = con.execute("""
-            SELECT clases.nombre, resultados.cuestionario,
-                   resultados.resultado, COUNT(*) total
-            FROM resultados
-            JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-            JOIN clases ON clases.id = estudiantes.clase_id
-            GROUP BY clases.nombre, resultados.cuestionario, resultados.resultado
-        """).fetchall()
+        fragmentos["selector"] = fragmentos_dashboard.obtener(
+            "selector",
+            clave + (version_seccion(con, LISTA_CLASES, ()), clase_seleccionada or ""),
+            lambda: seccion_selector(con, clase_seleccionada)
+        )
 
-        autoestima = con.execute("""
-            SELECT clases.nombre AS clase,
-                   resultados.resultado,
-                   COUNT(*) AS total
-            FROM resultados
-            JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-            JOIN clases ON clases.id = estudiantes.clase_id
-            WHERE resultados.cuestionario = 'Autoestima Rosenberg'
-            GROUP BY clases.nombre, resultados.resultado
-        """).fetchall()
+        fragmentos["grupo"] = ""
+        if clase_seleccionada:
+            fragmentos["grupo"] = fragmentos_dashboard.obtener(
+                "grupo",
+                (semilla(), clase_seleccionada, version_datos(con, clase_seleccionada)),
+                lambda: seccion_grupo(con, clase_seleccionada)
+            )
 
-        autoestima_riesgo = con.execute("""
-            SELECT clases.nombre,
-                   ROUND(
-                       100.0 * SUM(
-                           CASE WHEN resultados.resultado = 'Autoestima Baja'
-                           THEN 1 ELSE 0 END
-                       ) / COUNT(*), 1
-                   ) AS porcentaje_baja
-            FROM resultados
-            JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-            JOIN clases ON clases.id = estudiantes.clase_id
-            WHERE resultados.cuestionario = 'Autoestima Rosenberg'
-            GROUP BY clases.nombre
-        """).fetchall()
+    respuesta = make_response(render_template("dashboard.html", fragmentos=fragmentos))
 
-        salud_riesgo = con.execute("""
-            SELECT clases.nombre,
-                ROUND(
-                    100.0 * SUM(
-                        CASE WHEN resultados.resultado IN
-                        ('Riesgo moderado','Riesgo alto')
-                        THEN 1 ELSE 0 END
-                    ) / COUNT(*),1
-                ) porcentaje
-            FROM resultados
-            JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-            JOIN clases ON clases.id = estudiantes.clase_id
-            WHERE resultados.cuestionario='Cuestionario de Salud'
-            GROUP BY clases.nombre
-        """).fetchall()
+    if etiqueta:
+        con_etiqueta(respuesta, etiqueta)
+    return respuesta
 
-        habilidades = con.execute("""
-            SELECT clases.nombre,
-                   resultados.resultado,
-                   COUNT(*) total
-            FROM resultados
-            JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-            JOIN clases ON clases.id = estudiantes.clase_id
-            WHERE resultados.cuestionario = 'Habilidades'
-            GROUP BY clases.nombre, resultados.resultado
-        """).fetchall()
+def limpiar_resultado(texto):
+    if not texto:
+        return texto
+    if " | " in texto:
+        return texto.split(" | ", 1)[0]
+    return texto
 
-        estilos = con.execute("""
-            SELECT clases.nombre,
-                resultados.resultado AS estilo,
-                ROUND(
-                    100.0 * COUNT(*) /
-                    (
-                        SELECT COUNT(*)
-                        FROM resultados r2
-                        JOIN estudiantes e2 ON e2.id = r2.estudiante_id
-                        WHERE e2.clase_id = clases.id
-                        AND r2.cuestionario = 'Estilos de aprendizaje'
-                    ), 1
-                ) porcentaje
-            FROM resultados
-            JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-            JOIN clases ON clases.id = estudiantes.clase_id
-            WHERE resultados.cuestionario = 'Estilos de aprendizaje'
-            GROUP BY clases.nombre, estilo
-        """).fetchall()
+@app.route("/c/<codigo>")
+def acceso_clase(codigo):
 
-        tamizaje = con.execute("""
-            SELECT DISTINCT clases.nombre
-            FROM resultados
-            JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-            JOIN clases ON clases.id = estudiantes.clase_id
-            WHERE resultados.cuestionario LIKE 'Tamizaje -%'
-            AND resultados.resultado IN ('Requiere evaluación','Consumo de riesgo','Elevado','Moderado')
-        """).fetchall()
+    if "estudiante" in session:
+        ruta = siguiente_cuestionario(session["estudiante"])
+        return redirect(f"/{ruta}" if ruta else "/final")
 
-        salud = con.execute("""
-            SELECT clases.nombre,
-                   COUNT(*) total
-            FROM resultados
-            JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-            JOIN clases ON clases.id = estudiantes.clase_id
-            WHERE resultados.cuestionario = 'Cuestionario de Salud'
-            GROUP BY clases.nombre
-        """).fetchall()
+    with db() as con:
+        clase = con.execute(
+            "SELECT * FROM clases WHERE codigo=?",
+            (codigo,)
+        ).fetchone()
+
+        if not clase:
+            return "Clase no encontrada"
+
+    return render_template(
+        "acceso_clase.html",
+        clase=clase,
+        clase_id=clase["id"],
+        tests=list(plan_clase(clase["id"]))
+    )
+
+@app.route("/registro", methods=["POST"])
+def registro():
+
+    if "estudiante" in session:
+        ruta = siguiente_cuestionario(session["estudiante"])
+        return redirect(f"/{ruta}" if ruta else "/final")
+
+    token = uuid.uuid4().hex
+    user_agent = request.headers.get("User-Agent")
+
+    with db() as con:
+        con.execute("""
+            INSERT INTO estudiantes
+            (nombre, matricula, grupo, carrera, clase_id)
+            VALUES (?,?,?,?,?)
+        """, (
+            request.form["nombre"],
+            request.form["matricula"],
+            request.form.get("grupo", ""),
+            request.form["carrera"],
+            request.form["clase_id"]
+        ))
+
+        estudiante_id = con.execute(
+            "SELECT last_insert_rowid()"
+        ).fetchone()[0]
+
+        con.execute("""
+            INSERT INTO sesiones (estudiante_id, token, user_agent)
+            VALUES (?,?,?)
+        """, (estudiante_id, token, user_agent))
+
+        con.execute("""
+            UPDATE resumen_clases
+            SET registrados = registrados + 1
+            WHERE clase_id=?
+        """, (request.form["clase_id"],))
+
+        cambiar_version(con, request.form["clase_id"])
+
+    session["estudiante"] = estudiante_id
+    session["token"] = emitir_token_alumno(
+        estudiante_id,
+        request.form["nombre"],
+        request.form["matricula"],
+        request.form.get("grupo", ""),
+        request.form["carrera"]
+    )
+
+    return redirect("/" + siguiente_cuestionario(estudiante_id))
+
+@app.route("/eliminar_clase/<int:id>", methods=["POST"])
+def eliminar_clase(id):
+    if not session.get("admin"):
+        return redirect("/orientacion")
+
+    with db() as con:
+        revocar_sesiones(con, id)
+        borrar_datos_clase(con, id)
+        # Archivar conserva las tendencias; eliminar no
+        con.execute("DELETE FROM tendencias WHERE clase_id=?", (id,))
+        cambiar_version(con, id)
+
+    olvidar_clase(id)
+    avisar_mantenimiento()
+
+    return redirect("/dashboard")
+
+def borrar_datos_clase(con, clase_id):
+    # Lo que se ve desaparece en esta transacción; alumnos y resultados
+    # quedan en clases_por_borrar y el mantenimiento los borra por lotes,
+    # sin tener el candado de escritura más que unos milisegundos cada vez.
+    con.execute(
+        "INSERT OR IGNORE INTO clases_por_borrar (clase_id, pedida_en) VALUES (?,?)",
+        (clase_id, int(time.time()))
+    )
+    con.execute("DELETE FROM clase_cuestionarios WHERE clase_id=?", (clase_id,))
+    con.execute("DELETE FROM clases WHERE id=?", (clase_id,))
+    con.execute("DELETE FROM resumen_resultados WHERE clase_id=?", (clase_id,))
+    con.execute("DELETE FROM resumen_clases WHERE clase_id=?", (clase_id,))
+
+app.config.update(
+    ARCHIVO_DIR=os.environ.get("ARCHIVO_DIR", "archivo"),
+    ARCHIVO_CACHE=int(os.environ.get("ARCHIVO_CACHE", 8)),
+    ARCHIVO_CACHE_BYTES=int(os.environ.get("ARCHIVO_CACHE_MB", 64)) * 1024 * 1024,
+    ARCHIVO_INTENTOS=3
+)
+
+# Bytes ya descomprimidos de los archivos consultados hace poco
+archivos_clase = CacheLRU(app.config["ARCHIVO_CACHE"], app.config["ARCHIVO_CACHE_BYTES"])
+
+TABLAS_ARCHIVO = [
+    ("clases", "SELECT * FROM clases WHERE id=?"),
+    ("clase_cuestionarios", "SELECT * FROM clase_cuestionarios WHERE clase_id=?"),
+    ("estudiantes", "SELECT * FROM estudiantes WHERE clase_id=?"),
+    ("resultados", """
+        SELECT r.* FROM resultados r
+        JOIN estudiantes e ON e.id = r.estudiante_id
+        WHERE e.clase_id=?
+    """),
+    ("resumen_resultados", "SELECT * FROM resumen_resultados WHERE clase_id=?"),
+    ("resumen_clases", "SELECT * FROM resumen_clases WHERE clase_id=?"),
+    # Completas: el archivo debe leer los mismos códigos que la base viva
+    ("familias", "SELECT * FROM familias"),
+    ("cuestionarios", "SELECT * FROM cuestionarios"),
+    ("etiquetas", "SELECT * FROM etiquetas"),
+]
+
+def copiar_clase(con, clase_id):
+    # Lee la clase completa dentro de una transacción de lectura: en WAL es
+    # una foto consistente y no detiene a quien esté escribiendo.
+    copia = sqlite3.connect(":memory:")
+    copia.row_factory = sqlite3.Row
+    migrar(copia)
+
+    con.execute("BEGIN")
+    try:
+        clase = con.execute("SELECT * FROM clases WHERE id=?", (clase_id,)).fetchone()
+        if not clase:
+            return None
+        version = version_datos(con, clase_id)
+
+        copiadas = {}
+        with copia:
+            for tabla, sql in TABLAS_ARCHIVO:
+                cursor = con.execute(sql, (clase_id,) if "?" in sql else ())
+                columnas = [d[0] for d in cursor.description]
+                copia.executemany(
+                    f"INSERT OR REPLACE INTO {tabla} ({', '.join(columnas)}) "
+                    f"VALUES ({', '.join('?' * len(columnas))})",
+                    cursor
+                )
+                copiadas[tabla] = copia.execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0]
+    finally:
+        con.rollback()
+
+    datos = gzip.compress(copia.serialize(), compresslevel=6)
+    copia.close()
+    return clase, version, copiadas, datos
+
+def archivar_clase(con, clase_id):
+    # La clase completa pasa a un SQLite propio con el mismo esquema (así
+    # las mismas consultas sirven para leerlo), comprimido con gzip. La
+    # copia y el archivo se hacen sin candado; el de escritura solo se toma
+    # para comprobar que la versión de la clase no cambió mientras tanto y
+    # borrar sus filas de la base viva. Si cambió, se vuelve a copiar.
+    nombre_archivo = f"clase_{clase_id}.sqlite.gz"
+    destino = os.path.join(app.config["ARCHIVO_DIR"], nombre_archivo)
+    temporal = f"{destino}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(app.config["ARCHIVO_DIR"], exist_ok=True)
+
+    try:
+        for _ in range(app.config["ARCHIVO_INTENTOS"]):
+            copia = copiar_clase(con, clase_id)
+            if copia is None:
+                return None
+            clase, version, copiadas, datos = copia
+
+            with open(temporal, "wb") as f:
+                f.write(datos)
+                f.flush()
+                os.fsync(f.fileno())
+
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                if not con.execute("SELECT 1 FROM clases WHERE id=?", (clase_id,)).fetchone():
+                    con.rollback()
+                    return None
+                if version_datos(con, clase_id) != version:
+                    con.rollback()
+                    continue
+
+                os.replace(temporal, destino)
+                con.execute("""
+                    INSERT OR REPLACE INTO clases_archivadas
+                    (id, nombre, codigo, archivo, alumnos, resultados, bytes, archivada_en)
+                    VALUES (?,?,?,?,?,?,?,?)
+                """, (
+                    clase_id, clase["nombre"], clase["codigo"], nombre_archivo,
+                    copiadas["estudiantes"], copiadas["resultados"], len(datos), int(time.time())
+                ))
+                revocar_sesiones(con, clase_id)
+                borrar_datos_clase(con, clase_id)
+                cambiar_version(con, clase_id)
+                con.commit()
+            except Exception:
+                con.rollback()
+                raise
+            break
+        else:
+            raise sqlite3.OperationalError(
+                f"La clase {clase_id} siguió cambiando mientras se archivaba; intenta de nuevo"
+            )
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+
+    archivos_clase.pop(clase_id)
+    olvidar_clase(clase_id)
+    avisar_mantenimiento()
+    return copiadas["estudiantes"], copiadas["resultados"], len(datos)
+
+def abrir_archivo_clase(clase_id):
+    fila = db().execute(
+        "SELECT archivo FROM clases_archivadas WHERE id=?",
+        (clase_id,)
+    ).fetchone()
+    if not fila:
+        return None
+
+    con = sqlite3.connect(":memory:", check_same_thread=False)
+    con.row_factory = sqlite3.Row
+    try:
+        datos = archivos_clase.get(clase_id)
+        if datos is None:
+            with open(os.path.join(app.config["ARCHIVO_DIR"], fila["archivo"]), "rb") as f:
+                datos = gzip.decompress(f.read())
+
+        con.deserialize(datos)
+        # Un archivo hecho con un esquema anterior se pone al día en memoria
+        if migrar(con):
+            datos = con.serialize()
+    except (OSError, EOFError, zlib.error, sqlite3.DatabaseError) as e:
+        # Falta el archivo o está dañado: la clase se trata como inexistente
+        app.logger.warning("No se pudo abrir el archivo de la clase %s: %s", clase_id, e)
+        con.close()
+        return None
+
+    archivos_clase.put(clase_id, datos)
+    con.execute("PRAGMA query_only=1")
+    return con
+
+def conexion_clase(clase_id):
+    # (conexión, archivada): la base viva si la clase sigue ahí; si no, su
+    # archivo en solo lectura.
+    con = db()
+    if con.execute("SELECT 1 FROM clases WHERE id=?", (clase_id,)).fetchone():
+        return con, False
+
+    archivo = abrir_archivo_clase(clase_id)
+    if archivo is None:
+        return con, False
+    return archivo, True
+
+@app.route("/archivar_clase/<int:id>", methods=["POST"])
+def archivar_clase_ruta(id):
+    if not session.get("admin"):
+        return redirect("/orientacion")
+
+    archivar_clase(db(), id)
+
+    return redirect("/dashboard")
+
+@app.cli.command("archivar")
+@click.argument("clases", nargs=-1, type=int, required=True)
+def archivar_cmd(clases):
+    con = db()
+    for clase_id in clases:
+        archivada = archivar_clase(con, clase_id)
+        if archivada is None:
+            print(f"Clase {clase_id}: no existe")
+            continue
+        alumnos, resultados, tamano = archivada
+        print(f"Clase {clase_id}: {alumnos} alumnos, {resultados} resultados, {tamano / 1024:.1f} KiB")
+
+app.config.update(
+    MANTENIMIENTO=os.environ.get("MANTENIMIENTO", "1") == "1",
+    MANTENIMIENTO_INTERVALO=int(os.environ.get("MANTENIMIENTO_INTERVALO", 300)),
+    MANTENIMIENTO_LOTE=500,
+    # Debe ser mayor que SESION_ALUMNO_SEGUNDOS: solo se borran sesiones
+    # cuyo token firmado ya no puede estar vigente.
+    SESIONES_TTL=int(os.environ.get("SESIONES_TTL", 7 * 24 * 3600)),
+    VACUUM_PAGINAS=2000
+)
+
+def borrar_por_lotes(con, consulta, params, tabla, columna, lote):
+    # consulta devuelve los ids a borrar; cada lote es una transacción corta
+    # para que las entregas de otras clases no esperen detrás del borrado.
+    total = 0
+    while True:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            ids = [fila[0] for fila in con.execute(consulta + " LIMIT ?", params + (lote,))]
+            if ids:
+                con.execute(
+                    f"DELETE FROM {tabla} WHERE {columna} IN ({','.join('?' * len(ids))})",
+                    ids
+                )
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+
+        total += len(ids)
+        if len(ids) < lote:
+            return total
+
+CONSULTA_RESULTADOS_POR_BORRAR = """
+    SELECT r.id FROM resultados r
+    JOIN estudiantes e ON e.id = r.estudiante_id
+    WHERE e.clase_id=?
+"""
+
+CONSULTA_SESIONES_REVOCADAS = "SELECT estudiante_id FROM sesiones WHERE revocada_en < ?"
+
+CONSULTA_SESIONES_VIEJAS = "SELECT estudiante_id FROM sesiones WHERE creada_en < ?"
+
+def borrar_clases_pendientes(con, lote):
+    total = 0
+    for fila in con.execute("SELECT clase_id FROM clases_por_borrar").fetchall():
+        clase_id = fila["clase_id"]
+        total += borrar_por_lotes(
+            con, CONSULTA_RESULTADOS_POR_BORRAR, (clase_id,), "resultados", "id", lote
+        )
+        total += borrar_por_lotes(
+            con, "SELECT id FROM estudiantes WHERE clase_id=?", (clase_id,),
+            "estudiantes", "id", lote
+        )
+        # Las sesiones quedan revocadas; se van con la expiración de abajo
+        # cuando los demás workers ya no puedan necesitar la marca.
+        with con:
+            con.execute("DELETE FROM clases_por_borrar WHERE clase_id=?", (clase_id,))
+    return total
+
+def expirar_sesiones(con, lote):
+    ahora = int(time.time())
+    revocadas = borrar_por_lotes(
+        con, CONSULTA_SESIONES_REVOCADAS,
+        (ahora - app.config["SESION_ALUMNO_SEGUNDOS"],), "sesiones", "estudiante_id", lote
+    )
+    viejas = borrar_por_lotes(
+        con, CONSULTA_SESIONES_VIEJAS,
+        (ahora - app.config["SESIONES_TTL"],), "sesiones", "estudiante_id", lote
+    )
+    return revocadas + viejas
+
+def expirar_intentos(con, lote):
+    # Solo los bloqueos vigentes se vuelven a cargar al arrancar; el resto
+    # de los renglones ya no sirve.
+    return borrar_por_lotes(
+        con, "SELECT ip FROM intentos_admin WHERE IFNULL(bloqueado_hasta, 0) < ?",
+        (int(time.time()),), "intentos_admin", "ip", lote
+    )
+
+def vacuum_incremental(con):
+    if con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return None
+    libres = con.execute("PRAGMA freelist_count").fetchone()[0]
+    if libres:
+        con.execute(f"PRAGMA incremental_vacuum({app.config['VACUUM_PAGINAS']})").fetchall()
+    return libres - con.execute("PRAGMA freelist_count").fetchone()[0]
+
+def analizar(con):
+    # PRAGMA optimize solo mira las tablas que consultó esta misma conexión,
+    # y las del dashboard se consultan en los workers. Con analysis_limit el
+    # ANALYZE completo lee unos cientos de renglones por índice.
+    con.execute("PRAGMA analysis_limit=400")
+    con.execute("ANALYZE")
+    return None
+
+def mantenimiento(con):
+    lote = app.config["MANTENIMIENTO_LOTE"]
+    pasos = {}
+    for nombre, paso in [
+        ("clases_eliminadas", lambda: borrar_clases_pendientes(con, lote)),
+        ("sesiones", lambda: expirar_sesiones(con, lote)),
+        ("intentos_admin", lambda: expirar_intentos(con, lote)),
+        ("vacuum", lambda: vacuum_incremental(con)),
+        ("analyze", lambda: analizar(con)),
+    ]:
+        inicio = time.perf_counter()
+        filas = paso()
+        pasos[nombre] = {
+            "filas": filas,
+            "ms": round(1000 * (time.perf_counter() - inicio), 1)
+        }
+    return pasos
+
+ultimo_mantenimiento = None
+aviso_mantenimiento = threading.Event()
+mantenimiento_activo = False
+
+turno_mantenimiento = None
+
+def tomar_turno_mantenimiento():
+    # Con varios workers solo corre el mantenimiento el proceso que tiene
+    # el candado del archivo junto a la base. Si ese proceso muere el
+    # sistema suelta el candado y otro worker lo toma en su siguiente vuelta.
+    global turno_mantenimiento
+    if turno_mantenimiento is not None:
+        return True
+    try:
+        import fcntl
+    except ImportError:
+        return True
+
+    archivo = open(DB + ".mantenimiento", "a")
+    try:
+        fcntl.flock(archivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        archivo.close()
+        return False
+    turno_mantenimiento = archivo
+    return True
+
+def hilo_mantenimiento():
+    # La primera vuelta espera un intervalo completo: arrancar un worker no
+    # escribe en la base.
+    global ultimo_mantenimiento
+    con = None
+    while True:
+        aviso_mantenimiento.wait(app.config["MANTENIMIENTO_INTERVALO"])
+        aviso_mantenimiento.clear()
+        if not tomar_turno_mantenimiento():
+            continue
+        if con is None:
+            con = conectar()
+        try:
+            pasos = mantenimiento(con)
+        except sqlite3.Error as e:
+            app.logger.warning("Falló el mantenimiento: %s", e)
+            continue
+        ultimo_mantenimiento = {"fecha": int(time.time()), "pasos": pasos}
+        app.logger.info("Mantenimiento: %s", pasos)
+
+def iniciar_mantenimiento():
+    global mantenimiento_activo
+    with pool_lock:
+        if mantenimiento_activo:
+            return
+        mantenimiento_activo = True
+
+    threading.Thread(
+        target=hilo_mantenimiento,
+        name="mantenimiento",
+        daemon=True
+    ).start()
+
+def avisar_mantenimiento():
+    # Sin hilo de mantenimiento (CLI, MANTENIMIENTO=0) el borrado por lotes
+    # se hace aquí mismo. En un worker sin el turno el aviso no hace nada:
+    # las filas ya no se ven y las borra el dueño del turno en su vuelta.
+    if mantenimiento_activo:
+        aviso_mantenimiento.set()
+    else:
+        borrar_clases_pendientes(db(), app.config["MANTENIMIENTO_LOTE"])
+
+@app.route("/api/mantenimiento")
+def estado_mantenimiento():
+    if not session.get("admin"):
+        return redirect("/orientacion")
+
+    pendientes = db().execute("SELECT COUNT(*) FROM clases_por_borrar").fetchone()[0]
+    return {
+        "activo": mantenimiento_activo,
+        "turno": turno_mantenimiento is not None,
+        "clases_por_borrar": pendientes,
+        "ultimo": ultimo_mantenimiento
+    }
+
+@app.cli.command("mantenimiento")
+@click.option("--activar-vacuum", is_flag=True,
+              help="Cambia la base a auto_vacuum incremental (hace un VACUUM completo)")
+def mantenimiento_cmd(activar_vacuum):
+    con = db()
+    if activar_vacuum:
+        inicio = time.perf_counter()
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        con.execute("VACUUM")
+        print(f"vacuum completo: {1000 * (time.perf_counter() - inicio):.0f} ms")
+
+    for nombre, paso in mantenimiento(con).items():
+        filas = "-" if paso["filas"] is None else paso["filas"]
+        print(f"{nombre:18} {filas:>8} {paso['ms']:>9} ms")
+
+CONSULTA_DETALLE_SALUD = """
+    SELECT e.nombre, e.clase_id, etiquetas.nombre AS nivel, r.resultado
+    FROM resultados r
+    JOIN estudiantes e ON e.id = r.estudiante_id
+    LEFT JOIN etiquetas ON etiquetas.id = r.etiqueta_id
+    WHERE r.estudiante_id=?
+    AND r.cuestionario_id = (SELECT id FROM cuestionarios WHERE nombre = 'Cuestionario de Salud')
+    ORDER BY r.id DESC
+    LIMIT 1
+"""
+
+def detalle_salud(estudiante_id):
+    ahora = time.monotonic()
+    guardado = detalles_salud.get(estudiante_id)
+    if guardado:
+        if guardado[0] > ahora:
+            return guardado[1]
+        detalles_salud.pop(estudiante_id)
+
+    with db() as con:
+        fila = con.execute(CONSULTA_DETALLE_SALUD, (estudiante_id,)).fetchone()
+
+    if not fila:
+        return None
+
+    nivel, respuestas = descifrar_salud(fila["nivel"], fila["resultado"])
+
+    if respuestas is None and fila["resultado"]:
+        respuestas = {"Información": "No se pudo descifrar el registro"}
+    elif respuestas is None:
+        respuestas = {"Información": "Registro antiguo sin respuestas guardadas"}
+
+    detalle = {
+        "alumno": fila["nombre"],
+        "clase_id": fila["clase_id"],
+        "nivel": nivel,
+        "respuestas": {k: v for k, v in respuestas.items() if k != "alumno"}
+    }
+    detalles_salud.put(estudiante_id, (ahora + app.config["SALUD_CACHE_SEGUNDOS"], detalle))
+    return detalle
+
+@app.route("/salud_detalle/<int:estudiante_id>")
+def salud_detalle(estudiante_id):
+    if not session.get("admin"):
+        return redirect("/orientacion")
+
+    detalle = detalle_salud(estudiante_id)
+    if detalle is None:
+        return "Sin datos"
+
+    return render_template(
+        "salud_detalle.html",
+        alumno=detalle["alumno"],
+        nivel=detalle["nivel"],
+        respuestas=detalle["respuestas"]
+    )
+
+CONSULTA_RESULTADOS_CLASE = """
+    SELECT etiquetas.nombre AS resultado,
+           COUNT(*) total
+    FROM resultados
+    JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
+    JOIN etiquetas ON etiquetas.id = resultados.etiqueta_id
+    WHERE estudiantes.clase_id=?
+    AND resultados.cuestionario_id = (SELECT id FROM cuestionarios WHERE nombre=?)
+    GROUP BY resultados.etiqueta_id
+"""
+
+@app.route("/clase/<int:clase_id>/resultados")
+def resultados_clase(clase_id):
+    if not session.get("admin"):
+        return redirect("/orientacion")
+
+    with db() as con:
+        etiqueta = etiqueta_datos("resultados", clase_id, version_datos(con, clase_id))
+    respuesta = sin_cambios(etiqueta)
+    if respuesta:
+        return respuesta
+
+    con, archivada = conexion_clase(clase_id)
+    with con:
+        clase = con.execute(
+            "SELECT * FROM clases WHERE id=?",
+            (clase_id,)
+        ).fetchone()
+
+        estilos = con.execute(
+            CONSULTA_RESULTADOS_CLASE, (clase_id, "Estilos de aprendizaje")
+        ).fetchall()
+        autoestima = con.execute(
+            CONSULTA_RESULTADOS_CLASE, (clase_id, "Autoestima Rosenberg")
+        ).fetchall()
 
-        entregas = con.execute("""
-        SELECT clases.nombre,
-            COUNT(DISTINCT estudiantes.id) AS registrados,
-            COUNT(DISTINCT resultados.estudiante_id) AS entregados
-        FROM clases
-        LEFT JOIN estudiantes ON estudiantes.clase_id = clases.id
-        LEFT JOIN resultados ON resultados.estudiante_id = estudiantes.id
-        GROUP BY clases.id
-        """).fetchall()
+    if archivada:
+        con.close()
 
-        if clase_seleccionada:
-            stats_grupo = {}
-
-            total_grupo = con.execute("""
-                SELECT COUNT(DISTINCT estudiantes.id) total
-                FROM estudiantes
-                JOIN resultados ON resultados.estudiante_id = estudiantes.id
-                WHERE estudiantes.clase_id=?
-            """, (clase_seleccionada,)).fetchone()["total"]
-
-            stats_grupo["total"] = total_grupo
-
-            stats_grupo["estilos"] = con.execute("""
-                SELECT resultados.resultado AS estilo,
-                    COUNT(*) total,
-                    ROUND(100.0 * COUNT(*) /
-                        (SELECT COUNT(*)
-                        FROM resultados r2
-                        JOIN estudiantes e2 ON e2.id = r2.estudiante_id
-                        WHERE e2.clase_id=?
-                        AND r2.cuestionario='Estilos de aprendizaje'), 1
-                    ) porcentaje
-                FROM resultados
-                JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-                WHERE estudiantes.clase_id=?
-                AND resultados.cuestionario='Estilos de aprendizaje'
-                GROUP BY resultados.resultado
-            """, (clase_seleccionada, clase_seleccionada)).fetchall()
-
-            stats_grupo["autoestima"] = con.execute("""
-                SELECT resultados.resultado,
-                    COUNT(*) total,
-                    ROUND(100.0 * COUNT(*) / ?, 1) porcentaje
-                FROM resultados
-                JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-                WHERE estudiantes.clase_id=?
-                AND resultados.cuestionario='Autoestima Rosenberg'
-                GROUP BY resultados.resultado
-            """, (total_grupo, clase_seleccionada)).fetchall()
-
-            stats_grupo["habilidades"] = con.execute("""
-                SELECT resultados.resultado,
-                    COUNT(*) total,
-                    ROUND(100.0 * COUNT(*) / ?, 1) porcentaje
-                FROM resultados
-                JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-                WHERE estudiantes.clase_id=?
-                AND resultados.cuestionario='Habilidades'
-                GROUP BY resultados.resultado
-            """, (total_grupo, clase_seleccionada)).fetchall()
-
-            stats_grupo["tamizaje"] = {}
-
-            for area in [
-                "Tamizaje - Depresión",
-                "Tamizaje - Ansiedad",
-                "Tamizaje - Alcohol",
-                "Tamizaje - Neurodivergencia"
-            ]:
-                stats_grupo["tamizaje"][area] = con.execute("""
-                    SELECT resultado,
-                        COUNT(*) total,
-                        ROUND(100.0 * COUNT(*) / ?, 1) porcentaje
-                    FROM resultados
-                    JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-                    WHERE estudiantes.clase_id=?
-                    AND resultados.cuestionario=?
-                    GROUP BY resultado
-                """, (total_grupo, clase_seleccionada, area)).fetchall()
-
-            stats_grupo["total"] = total_grupo
-
-            stats_grupo["salud"] = con.execute("""
-                SELECT
-                    CASE
-                        WHEN instr(resultados.resultado, ' | ') > 0
-                        THEN substr(resultados.resultado, 1, instr(resultados.resultado, ' | ') - 1)
-                        ELSE resultados.resultado
-                    END AS resultado,
-                    COUNT(*) total,
-                    ROUND(100.0 * COUNT(*) / ?, 1) porcentaje
-                FROM resultados
-                JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-                WHERE estudiantes.clase_id=?
-                AND resultados.cuestionario='Cuestionario de Salud'
-                GROUP BY resultado
-            """, (total_grupo, clase_seleccionada)).fetchall()
+    if not clase:
+        return "Clase no encontrada", 404
 
-    return render_template(
-        "dashboard.html",
-        clases=clases,
-        datos=resultados,
-        autoestima=autoestima,
-        autoestima_riesgo=autoestima_riesgo,
-        salud_riesgo=salud_riesgo,
-        habilidades=habilidades,
+    return con_etiqueta(make_response(render_template(
+        "resultados_clase.html",
+        clase=clase,
         estilos=estilos,
-        entregas=entregas,
-        stats_grupo=stats_grupo,
-        clase_seleccionada=clase_seleccionada,
-        tamizaje=tamizaje
-    )
+        autoestima=autoestima,
+        archivada=archivada
+    )), etiqueta)
+
+app.config.setdefault("ALUMNOS_POR_PAGINA", 50)
+app.config.setdefault("ALUMNOS_POR_PAGINA_MAX", 500)
+
+CONSULTA_PAGINA_ALUMNOS = """
+    SELECT e.id, e.nombre
+    FROM estudiantes e
+    WHERE {condiciones}
+    ORDER BY e.nombre, e.id
+    LIMIT ?
+"""
+
+CONSULTA_RESULTADOS_ALUMNOS = """
+    SELECT e.id, e.nombre, e.carrera,
+        c.nombre AS cuestionario,
+        et.nombre AS resultado
+    FROM estudiantes e
+    LEFT JOIN resultados r ON r.estudiante_id = e.id
+    LEFT JOIN cuestionarios c ON c.id = r.cuestionario_id
+    LEFT JOIN etiquetas et ON et.id = r.etiqueta_id
+    WHERE e.id IN ({ids})
+    {filtro}
+    ORDER BY e.nombre, e.id
+"""
+
+def frase_fts(texto):
+    return '"' + texto.replace('"', '""') + '"'
 
-def limpiar_resultado(texto):
-    if not texto:
-        return texto
-    if " | " in texto:
-        return texto.split(" | ", 1)[0]
-    return texto
+@app.route("/clase/<int:clase_id>/alumnos")
+def alumnos_clase(clase_id):
+    if not session.get("admin"):
+        return redirect("/orientacion")
 
-@app.route("/c/<codigo>")
-def acceso_clase(codigo):
+    alumno = request.args.get("alumno", "").strip()
+    carrera = request.args.get("carrera", "").strip()
+    cuestionario = request.args.get("cuestionario", "").strip()
+    resultado = request.args.get("resultado", "").strip()
+    por_pagina = max(1, min(
+        request.args.get("por_pagina", app.config["ALUMNOS_POR_PAGINA"], type=int),
+        app.config["ALUMNOS_POR_PAGINA_MAX"]
+    ))
+    despues_nombre = request.args.get("despues_nombre")
+    despues_id = request.args.get("despues_id", type=int)
+
+    condiciones = ["e.clase_id=?"]
+    params = [clase_id]
+
+    busqueda = []
+    cortos = []
+    for columnas, texto in [("{nombre matricula}", alumno), ("carrera", carrera)]:
+        if len(texto) >= 3:
+            busqueda.append(f"{columnas} : {frase_fts(texto)}")
+        elif texto:
+            cortos.append((columnas, texto))
+
+    if busqueda:
+        condiciones.append(
+            "e.id IN (SELECT rowid FROM estudiantes_fts WHERE estudiantes_fts MATCH ?)"
+        )
+        params.append(" AND ".join(busqueda))
 
-    if "estudiante" in session:
-        ruta = siguiente_cuestionario(session["estudiante"])
-        return redirect(f"/{ruta}" if ruta else "/final")
+    # El índice trigram necesita al menos 3 caracteres
+    for columnas, texto in cortos:
+        if columnas == "carrera":
+            condiciones.append("e.carrera LIKE ?")
+            params.append(f"%{texto}%")
+        else:
+            condiciones.append("(e.nombre LIKE ? OR e.matricula LIKE ?)")
+            params += [f"%{texto}%", f"%{texto}%"]
+
+    filtro_resultados = ""
+    params_resultados = []
+    if cuestionario or resultado:
+        filtro_resultados = """
+            AND r.cuestionario_id IN (SELECT id FROM cuestionarios WHERE nombre LIKE ?)
+            AND r.etiqueta_id IN (SELECT id FROM etiquetas WHERE nombre LIKE ?)
+        """
+        params_resultados = [f"%{cuestionario}%", f"%{resultado}%"]
+        condiciones.append(f"""
+            EXISTS (
+                SELECT 1 FROM resultados r
+                WHERE r.estudiante_id = e.id
+                {filtro_resultados}
+            )
+        """)
+        params += params_resultados
 
-    with db() as con:
+    if despues_nombre is not None and despues_id is not None:
+        condiciones.append("(e.nombre, e.id) > (?, ?)")
+        params += [despues_nombre, despues_id]
+
+    con, archivada = conexion_clase(clase_id)
+    with con:
         clase = con.execute(
-            "SELECT * FROM clases WHERE codigo=?",
-            (codigo,)
+            "SELECT * FROM clases WHERE id=?",
+            (clase_id,)
         ).fetchone()
 
-        if not clase:
-            return "Clase no encontrada"
-
-        tests = con.execute(
-            "SELECT cuestionario FROM clase_cuestionarios WHERE clase_id=?",
-            (clase["id"],)
+        pagina = con.execute(
+            CONSULTA_PAGINA_ALUMNOS.format(condiciones=" AND ".join(condiciones)),
+            params + [por_pagina + 1]
         ).fetchall()
 
+        siguiente = None
+        if len(pagina) > por_pagina:
+            pagina = pagina[:por_pagina]
+            siguiente = {
+                "despues_nombre": pagina[-1]["nombre"],
+                "despues_id": pagina[-1]["id"]
+            }
+
+        ids = [fila["id"] for fila in pagina]
+
+        alumnos = con.execute(
+            CONSULTA_RESULTADOS_ALUMNOS.format(
+                ids=",".join("?" * len(ids)), filtro=filtro_resultados
+            ),
+            ids + params_resultados
+        ).fetchall() if ids else []
+
+    if archivada:
+        con.close()
+
+    if not clase:
+        return "Clase no encontrada", 404
+
+    filtros = {
+        "alumno": alumno,
+        "carrera": carrera,
+        "cuestionario": cuestionario,
+        "resultado": resultado,
+        "por_pagina": por_pagina
+    }
+
     return render_template(
-        "acceso_clase.html",
+        "alumnos_clase.html",
         clase=clase,
-        clase_id=clase["id"],
-        tests=[t["cuestionario"] for t in tests]
+        archivada=archivada,
+        alumnos=alumnos,
+        filtros=filtros,
+        siguiente=dict(filtros, **siguiente) if siguiente else None
     )
 
-@app.route("/registro", methods=["POST"])
-def registro():
-
-    if "estudiante" in session:
-        ruta = siguiente_cuestionario(session["estudiante"])
-        return redirect(f"/{ruta}" if ruta else "/final")
-
-    token = uuid.uuid4().hex
-    user_agent = request.headers.get("User-Agent")
+COLUMNAS_EXPORTACION = [
+    ("Estilos", "Estilos de aprendizaje"),
+    ("Autoestima", "Autoestima Rosenberg"),
+    ("Habilidades", "Habilidades"),
+    ("Depresión", "Tamizaje - Depresión"),
+    ("Ansiedad", "Tamizaje - Ansiedad"),
+    ("Alcohol", "Tamizaje - Alcohol"),
+    ("Neurodivergencia", "Tamizaje - Neurodivergencia"),
+    ("Salud", "Cuestionario de Salud"),
+]
+
+ENCABEZADO_EXPORTACION = (
+    ["Clase", "Alumno", "Matrícula", "Grupo", "Carrera"]
+    + [titulo for titulo, _ in COLUMNAS_EXPORTACION]
+)
 
-    with db() as con:
-        con.execute("""
-            INSERT INTO estudiantes
-            (nombre, matricula, grupo, carrera, clase_id)
-            VALUES (?,?,?,?,?)
-        """, (
-            request.form["nombre"],
-            request.form["matricula"],
-            request.form.get("grupo", ""),
-            request.form["carrera"],
-            request.form["clase_id"]
-        ))
+# Si un alumno tiene más de un resultado del mismo cuestionario (p. ej.
+# importado y luego contestado en línea) cuenta el último, como en su
+# detalle; cada columna es una búsqueda por índice en resultados.
+COLUMNA_EXPORTACION = """(
+        SELECT et.nombre
+        FROM resultados r
+        JOIN etiquetas et ON et.id = r.etiqueta_id
+        WHERE r.estudiante_id = e.id AND r.cuestionario_id = ?
+        ORDER BY r.id DESC
+        LIMIT 1
+    )"""
+
+CONSULTA_EXPORTACION = """
+    SELECT e.nombre, e.matricula, e.grupo, e.carrera,
+           {columnas}
+    FROM estudiantes e
+    WHERE e.clase_id=?
+    ORDER BY e.nombre, e.id
+"""
+
+def filas_exportacion(clases):
+    # Un renglón por alumno; el cursor se recorre sin fetchall.
+    consulta = CONSULTA_EXPORTACION.format(columnas=",\n".join(
+        COLUMNA_EXPORTACION for _ in COLUMNAS_EXPORTACION
+    ))
+
+    con = db()
+    params = [codigo(con, "cuestionarios", cuestionario) for _, cuestionario in COLUMNAS_EXPORTACION]
+    for clase in clases:
+        cursor = con.execute(consulta, params + [clase["id"]])
+
+        for fila in cursor:
+            yield [clase["nombre"]] + list(fila)
+
+class SalidaEnBloques:
+    def __init__(self):
+        self.partes = []
+
+    def write(self, datos):
+        self.partes.append(bytes(datos))
+        return len(datos)
+
+    def flush(self):
+        pass
+
+    def vaciar(self):
+        datos = b"".join(self.partes)
+        self.partes = []
+        return datos
+
+XLSX_FIJOS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Resultados" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
 
-        estudiante_id = con.execute(
-            "SELECT last_insert_rowid()"
-        ).fetchone()[0]
+def celda_xlsx(valor):
+    texto = "" if valor is None else str(valor)
+    texto = "".join(c for c in texto if c in "\t\n\r" or c >= " ")
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{xml_escape(texto)}</t></is></c>'
 
-        con.execute("""
-            INSERT INTO sesiones (estudiante_id, token, user_agent)
-            VALUES (?,?,?)
-        """, (estudiante_id, token, user_agent))
+def renglon_xlsx(fila):
+    return ("<row>" + "".join(map(celda_xlsx, fila)) + "</row>").encode()
 
-    session["estudiante"] = estudiante_id
-    session["token"] = token
+def generar_csv(filas):
+    salida = io.StringIO()
+    escritor = csv.writer(salida)
+    escritor.writerow(ENCABEZADO_EXPORTACION)
 
-    return redirect("/" + siguiente_cuestionario(estudiante_id))
+    for i, fila in enumerate(filas, start=1):
+        escritor.writerow(fila)
+        if i % 200 == 0:
+            yield salida.getvalue()
+            salida.seek(0)
+            salida.truncate()
 
-@app.route("/eliminar_clase/<int:id>", methods=["POST"])
-def eliminar_clase(id):
-    if not session.get("admin"):
-        return redirect("/orientacion")
+    yield salida.getvalue()
 
-    with db() as con:
-        con.execute("DELETE FROM resultados WHERE estudiante_id IN (SELECT id FROM estudiantes WHERE clase_id=?)", (id,))
-        con.execute("DELETE FROM estudiantes WHERE clase_id=?", (id,))
-        con.execute("DELETE FROM clase_cuestionarios WHERE clase_id=?", (id,))
-        con.execute("DELETE FROM clases WHERE id=?", (id,))
+def generar_xlsx(filas):
+    salida = SalidaEnBloques()
 
-    return redirect("/dashboard")
+    with zipfile.ZipFile(salida, "w", zipfile.ZIP_DEFLATED) as libro:
+        for nombre, contenido in XLSX_FIJOS.items():
+            libro.writestr(nombre, contenido)
+        yield salida.vaciar()
 
-@app.route("/salud_detalle/<nombre>")
-def salud_detalle(nombre):
-    if not session.get("admin"):
-        return redirect("/orientacion")
+        with libro.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as hoja:
+            hoja.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            ).encode())
 
-    with db() as con:
-        fila = con.execute("""
-            SELECT resultado
-            FROM resultados r
-            JOIN estudiantes e ON e.id = r.estudiante_id
-            WHERE e.nombre=?
-            AND r.cuestionario='Cuestionario de Salud'
-            ORDER BY r.id DESC
-            LIMIT 1
-        """, (nombre,)).fetchone()
+            hoja.write(renglon_xlsx(ENCABEZADO_EXPORTACION))
 
-    if not fila:
-        return "Sin datos"
+            for i, fila in enumerate(filas, start=1):
+                hoja.write(renglon_xlsx(fila))
+                if i % 200 == 0:
+                    yield salida.vaciar()
 
-    texto = fernet.decrypt(fila["resultado"].encode()).decode()
+            hoja.write(b"</sheetData></worksheet>")
 
-    if " | " in texto:
-        nivel, respuestas = texto.split(" | ", 1)
-        respuestas = json.loads(respuestas)
-    else:
-        nivel = texto
-        respuestas = {"Información": "Registro antiguo sin respuestas guardadas"}
+    yield salida.vaciar()
 
-    respuestas = {k: v for k, v in respuestas.items() if k != "alumno"}
+TIPOS_EXPORTACION = {
+    "csv": (generar_csv, "text/csv"),
+    "xlsx": (generar_xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
 
-    return render_template(
-        "salud_detalle.html",
-        alumno=nombre,
-        nivel=nivel,
-        respuestas=respuestas
+def respuesta_exportacion(clases, formato, archivo):
+    generar, mimetype = TIPOS_EXPORTACION[formato]
+    return Response(
+        stream_with_context(generar(filas_exportacion(clases))),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={archivo}.{formato}"}
     )
 
-@app.route("/clase/<int:clase_id>/resultados")
-def resultados_clase(clase_id):
+@app.route("/clase/<int:clase_id>/export.<any(csv, xlsx):formato>")
+def exportar_clase(clase_id, formato):
     if not session.get("admin"):
         return redirect("/orientacion")
 
     with db() as con:
         clase = con.execute(
-            "SELECT * FROM clases WHERE id=?",
+            "SELECT id, nombre FROM clases WHERE id=?",
             (clase_id,)
         ).fetchone()
 
-        estilos = con.execute("""
-            SELECT resultados.resultado AS estilo,
-                   COUNT(*) total
-            FROM resultados
-            JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-            WHERE estudiantes.clase_id=?
-            AND resultados.cuestionario='Estilos de aprendizaje'
-            GROUP BY resultados.resultado
-        """, (clase_id,)).fetchall()
-
-        autoestima = con.execute("""
-            SELECT resultados.resultado,
-                   COUNT(*) total
-            FROM resultados
-            JOIN estudiantes ON estudiantes.id = resultados.estudiante_id
-            WHERE estudiantes.clase_id=?
-            AND resultados.cuestionario='Autoestima Rosenberg'
-            GROUP BY resultados.resultado
-        """, (clase_id,)).fetchall()
+    if not clase:
+        return "Clase no encontrada", 404
 
-    return render_template(
-        "resultados_clase.html",
-        clase=clase,
-        estilos=estilos,
-        autoestima=autoestima
-    )
+    return respuesta_exportacion([clase], formato, f"clase_{clase_id}")
 
-@app.route("/clase/<int:clase_id>/alumnos")
-def alumnos_clase(clase_id):
+@app.route("/export.<any(csv, xlsx):formato>")
+def exportar_institucion(formato):
     if not session.get("admin"):
         return redirect("/orientacion")
 
-    alumno = request.args.get("alumno", "")
-    carrera = request.args.get("carrera", "")
-    cuestionario = request.args.get("cuestionario", "")
-    resultado = request.args.get("resultado", "")
+    def clases():
+        # Una clase a la vez, paginando por id.
+        ultimo_id = 0
+        while True:
+            clase = db().execute(
+                "SELECT id, nombre FROM clases WHERE id > ? ORDER BY id LIMIT 1",
+                (ultimo_id,)
+            ).fetchone()
+            if not clase:
+                return
+            yield clase
+            ultimo_id = clase["id"]
+
+    return respuesta_exportacion(clases(), formato, "resultados")
+
+app.config.setdefault("IMPORTAR_LOTE", 200)
+
+CAMPOS_ALUMNO = ["nombre", "matricula", "grupo", "carrera"]
+
+def columnas_importacion(plan):
+    columnas = list(CAMPOS_ALUMNO)
+    for cuestionario in plan:
+        ruta = RUTAS_CUESTIONARIOS[cuestionario]
+        for nombre in CUESTIONARIOS[cuestionario]:
+            columnas += [f"{ruta}.{item}" for item in ESCALAS[nombre]["items"]]
+    return columnas
+
+def texto_celda(valor):
+    if valor is None:
+        return ""
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)
+    return str(valor).strip()
+
+def leer_filas_importacion(nombre_archivo, flujo):
+    if nombre_archivo.lower().endswith(".xlsx"):
+        try:
+            import openpyxl
+        except ImportError:
+            raise ValueError("Para importar XLSX instala openpyxl o sube un CSV")
+
+        libro = openpyxl.load_workbook(flujo, read_only=True, data_only=True)
+        renglones = libro.active.iter_rows(values_only=True)
+        encabezado = [texto_celda(c) for c in next(renglones, [])]
+        for renglon in renglones:
+            yield dict(zip(encabezado, map(texto_celda, renglon)))
+        libro.close()
+        return
+
+    lector = csv.DictReader(io.TextIOWrapper(flujo, encoding="utf-8-sig", newline=""))
+    for renglon in lector:
+        yield {k.strip(): texto_celda(v) for k, v in renglon.items() if k}
+
+def preparar_lote(plan, numerados):
+    # Califica el lote por escala con etiquetas_matriz; devuelve alumnos
+    # válidos con sus resultados y los errores por renglón.
+    alumnos, errores = [], []
+    vectores = {}
+
+    for numero, fila in numerados:
+        if not fila.get("nombre") or not fila.get("carrera"):
+            errores.append((numero, "Faltan nombre o carrera"))
+            continue
+
+        try:
+            respuestas_alumno = []
+            for cuestionario in plan:
+                ruta = RUTAS_CUESTIONARIOS[cuestionario]
+                respuestas = {
+                    k.split(".", 1)[1]: v
+                    for k, v in fila.items()
+                    if k.startswith(ruta + ".") and v != ""
+                }
+                if not respuestas:
+                    continue
+                for nombre in CUESTIONARIOS[cuestionario]:
+                    try:
+                        vector = codificar(ESCALAS[nombre], respuestas)
+                    except ValueError:
+                        raise ValueError(f"Respuestas incompletas en {nombre}")
+                    respuestas_alumno.append((nombre, vector, respuestas))
+        except ValueError as e:
+            errores.append((numero, str(e)))
+            continue
+
+        alumnos.append((fila, respuestas_alumno))
+        for nombre, vector, _ in respuestas_alumno:
+            vectores.setdefault(nombre, []).append(vector)
+
+    etiquetas = {
+        nombre: iter(etiquetas_matriz(ESCALAS[nombre], lista))
+        for nombre, lista in vectores.items()
+    }
+
+    preparados = []
+    for fila, respuestas_alumno in alumnos:
+        filas = []
+        for nombre, vector, respuestas in respuestas_alumno:
+            etiqueta = next(etiquetas[nombre])
+            if nombre == "Cuestionario de Salud":
+                filas.append((nombre, cifrar_respuestas(respuestas), etiqueta, None))
+            else:
+                filas.append((nombre, etiqueta, None, json.dumps(vector, separators=(",", ":"))))
+        preparados.append((fila, filas))
+
+    return preparados, errores
+
+def comprobar_clase_abierta(con, clase_id):
+    if con.execute("SELECT 1 FROM clases WHERE id=?", (clase_id,)).fetchone():
+        return
+    if con.execute("SELECT 1 FROM clases_archivadas WHERE id=?", (clase_id,)).fetchone():
+        raise ValueError(f"La clase {clase_id} está archivada")
+    raise ValueError(f"La clase {clase_id} no existe")
+
+def guardar_lote(con, clase_id, preparados):
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        # Otra vez con el candado tomado: pudo eliminarse entre lotes
+        comprobar_clase_abierta(con, clase_id)
+
+        # Con el candado de escritura tomado, los ids siguientes son nuestros
+        base = con.execute(
+            "SELECT IFNULL(MAX(id), 0) FROM estudiantes"
+        ).fetchone()[0]
+        base = max(base, con.execute(
+            "SELECT IFNULL(MAX(seq), 0) FROM sqlite_sequence WHERE name='estudiantes'"
+        ).fetchone()[0])
+
+        estudiantes, sesiones, resultados = [], [], []
+        resumen, conteos = {}, {}
+        entregados = 0
+        ahora = int(time.time())
+        dia = date.fromtimestamp(ahora)
+
+        for i, (fila, filas) in enumerate(preparados, start=1):
+            estudiante_id = base + i
+            estudiantes.append((
+                estudiante_id, fila["nombre"], fila.get("matricula", ""),
+                fila.get("grupo", ""), fila["carrera"], clase_id
+            ))
+            sesiones.append((estudiante_id, uuid.uuid4().hex, "importación"))
+            for cuestionario_id, etiqueta_id, resultado, respuestas in filas_codificadas(con, filas):
+                resultados.append((estudiante_id, cuestionario_id, etiqueta_id, resultado, respuestas, ahora))
+                clave = (clase_id, cuestionario_id, etiqueta_id)
+                resumen[clave] = resumen.get(clave, 0) + 1
+                conteos[(dia,) + clave] = conteos.get((dia,) + clave, 0) + 1
+            if filas:
+                entregados += 1
+
+        con.executemany("""
+            INSERT INTO estudiantes (id, nombre, matricula, grupo, carrera, clase_id)
+            VALUES (?,?,?,?,?,?)
+        """, estudiantes)
+        con.executemany("""
+            INSERT INTO sesiones (estudiante_id, token, user_agent)
+            VALUES (?,?,?)
+        """, sesiones)
+        con.executemany("""
+            INSERT INTO resultados (estudiante_id, cuestionario_id, etiqueta_id, resultado, respuestas, creado_en)
+            VALUES (?,?,?,?,?,?)
+        """, resultados)
+        con.executemany("""
+            INSERT INTO resumen_resultados (clase_id, cuestionario_id, etiqueta_id, total)
+            VALUES (?,?,?,?)
+            ON CONFLICT(clase_id, cuestionario_id, etiqueta_id)
+            DO UPDATE SET total = total + excluded.total
+        """, [clave + (total,) for clave, total in resumen.items()])
+        sumar_tendencias(con, conteos)
+        con.execute("""
+            UPDATE resumen_clases
+            SET registrados = registrados + ?, entregados = entregados + ?
+            WHERE clase_id=?
+        """, (len(estudiantes), entregados, clase_id))
+        cambiar_version(con, clase_id)
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+
+    return len(estudiantes)
+
+def importar_alumnos(con, clase_id, filas):
+    comprobar_clase_abierta(con, clase_id)
+    plan = plan_clase(clase_id)
+    lote = app.config["IMPORTAR_LOTE"]
+    importados = 0
+    errores = []
+
+    numerados = []
+    for numero, fila in enumerate(filas, start=2):
+        numerados.append((numero, fila))
+        if len(numerados) == lote:
+            preparados, fallas = preparar_lote(plan, numerados)
+            importados += guardar_lote(con, clase_id, preparados)
+            errores += fallas
+            numerados = []
+
+    if numerados:
+        preparados, fallas = preparar_lote(plan, numerados)
+        importados += guardar_lote(con, clase_id, preparados)
+        errores += fallas
+
+    return importados, errores
+
+@app.route("/clase/<int:clase_id>/importar", methods=["GET", "POST"])
+def importar_clase(clase_id):
+    if not session.get("admin"):
+        return redirect("/orientacion")
 
     with db() as con:
         clase = con.execute(
@@ -583,36 +3869,151 @@ def alumnos_clase(clase_id):
             (clase_id,)
         ).fetchone()
 
-        alumnos = con.execute("""
-            SELECT e.nombre, e.carrera,
-                r.cuestionario,
-                CASE
-                    WHEN r.cuestionario = 'Cuestionario de Salud'
-                    THEN substr(r.resultado, 1, instr(r.resultado, ' |') - 1)
-                    ELSE r.resultado
-                END AS resultado
-            FROM estudiantes e
-            LEFT JOIN resultados r ON r.estudiante_id = e.id
-            WHERE e.clase_id=?
-            AND e.nombre LIKE ?
-            AND e.carrera LIKE ?
-            AND IFNULL(r.cuestionario,'') LIKE ?
-            AND IFNULL(r.resultado,'') LIKE ?
-            ORDER BY e.nombre
-        """, (
-            clase_id,
-            f"%{alumno}%",
-            f"%{carrera}%",
-            f"%{cuestionario}%",
-            f"%{resultado}%"
-        )).fetchall()
+    if not clase:
+        return "Clase no encontrada", 404
+
+    resumen = None
+
+    if request.method == "POST":
+        archivo = request.files.get("archivo")
+        if not archivo or not archivo.filename:
+            return "Error: selecciona un archivo", 400
+
+        inicio = time.perf_counter()
+        try:
+            importados, errores = importar_alumnos(
+                db(), clase_id, leer_filas_importacion(archivo.filename, archivo.stream)
+            )
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            return f"Error: no se pudo leer el archivo ({e})", 400
+
+        resumen = {
+            "importados": importados,
+            "errores": errores,
+            "segundos": round(time.perf_counter() - inicio, 2)
+        }
 
     return render_template(
-        "alumnos_clase.html",
+        "importar.html",
         clase=clase,
-        alumnos=alumnos
+        columnas=columnas_importacion(plan_clase(clase_id)),
+        resumen=resumen
+    )
+
+@app.route("/clase/<int:clase_id>/importar/plantilla.csv")
+def plantilla_importacion(clase_id):
+    if not session.get("admin"):
+        return redirect("/orientacion")
+
+    salida = io.StringIO()
+    csv.writer(salida).writerow(columnas_importacion(plan_clase(clase_id)))
+    return Response(
+        salida.getvalue(),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename=plantilla_clase_{clase_id}.csv"}
     )
 
+@app.cli.command("importar")
+@click.argument("clase_id", type=int)
+@click.argument("archivo", type=click.Path(exists=True, dir_okay=False))
+def importar_cmd(clase_id, archivo):
+    inicio = time.perf_counter()
+    with open(archivo, "rb") as flujo:
+        try:
+            importados, errores = importar_alumnos(
+                db(), clase_id, leer_filas_importacion(archivo, flujo)
+            )
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
+    for numero, mensaje in errores:
+        print(f"Renglón {numero}: {mensaje}")
+    print(f"{importados} alumnos importados en {time.perf_counter() - inicio:.1f}s")
+
+@app.route("/metrics")
+def metricas_prometheus():
+    token = app.config["METRICAS_TOKEN"]
+    autorizado = session.get("admin") or (
+        token and request.headers.get("Authorization") == f"Bearer {token}"
+    )
+    if not autorizado:
+        # Un recolector no sigue redirecciones al login
+        return Response(
+            "No autorizado\n",
+            status=403 if request.headers.get("Authorization") else 401,
+            headers={"WWW-Authenticate": "Bearer"},
+            mimetype="text/plain"
+        )
+
+    extras = []
+    if pool is not None:
+        extras.append(("pool_conexiones_libres", "Conexiones libres en el pool", pool.disponibles()))
+    if escritor is not None:
+        extras.append(("escritura_en_cola", "Pedidos esperando al escritor", escritor.cola.qsize()))
+
+    return Response(metricas.texto(extras), mimetype="text/plain; version=0.0.4")
+
+def leer_consultas_lentas():
+    archivo = app.config["CONSULTAS_LENTAS_ARCHIVO"]
+    archivos = [f"{archivo}.{n}" for n in range(app.config["CONSULTAS_LENTAS_RESPALDOS"], 0, -1)]
+
+    # Del respaldo más viejo al archivo actual, así el último plan visto gana
+    for ruta in archivos + [archivo]:
+        try:
+            with open(ruta, encoding="utf-8") as f:
+                for linea in f:
+                    try:
+                        yield json.loads(linea)
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            continue
+
+def resumen_consultas_lentas(limite=50):
+    resumen = {}
+    for r in leer_consultas_lentas():
+        c = resumen.setdefault(r["consulta"], {
+            "consulta": r["consulta"], "veces": 0, "total_ms": 0.0,
+            "max_ms": 0.0, "filas": 0, "con_filas": 0
+        })
+        c["veces"] += 1
+        c["total_ms"] += r["ms"]
+        c["max_ms"] = max(c["max_ms"], r["ms"])
+        if r.get("filas") is not None:
+            c["filas"] += r["filas"]
+            c["con_filas"] += 1
+        c["parametros"] = r.get("parametros")
+        c["plan"] = r.get("plan")
+        c["ultima"] = r.get("fecha")
+
+    peores = sorted(resumen.values(), key=lambda c: c["total_ms"], reverse=True)[:limite]
+    for c in peores:
+        c["total_ms"] = round(c["total_ms"], 1)
+        c["promedio_ms"] = round(c["total_ms"] / c["veces"], 1)
+        c["filas"] = round(c["filas"] / c["con_filas"]) if c["con_filas"] else None
+    return peores
+
+@app.route("/consultas_lentas")
+def consultas_lentas():
+    if not session.get("admin"):
+        return redirect("/orientacion")
+
+    return render_template(
+        "consultas_lentas.html",
+        consultas=resumen_consultas_lentas(),
+        umbral=app.config["CONSULTAS_LENTAS_MS"]
+    )
+
+@app.route("/api/escritura")
+def estado_escritura():
+    if not session.get("admin"):
+        return redirect("/orientacion")
+
+    if escritor is None:
+        return {"activa": app.config["ESCRITURA_AGRUPADA"], "en_cola": 0, "lotes": 0}
+
+    return dict(escritor.estado(), activa=app.config["ESCRITURA_AGRUPADA"])
+
 @app.route("/habilidades", methods=["GET","POST"])
 def habilidades():
     if "estudiante" not in session:
@@ -623,89 +4024,208 @@ def habilidades():
         return redirect("/")
     
     if request.method == "POST":
-        no = sum(1 for v in request.form.values() if v == "no")
-
-        nivel = (
-            "Muy bajo" if no >= 16 else
-            "Bajo" if no >= 13 else
-            "Promedio" if no >= 10 else
-            "Adecuado"
-        )
-
-        with db() as con:
-            con.execute(
-                "INSERT INTO resultados (estudiante_id, cuestionario, resultado) VALUES (?,?,?)",
-                (session["estudiante"], "Habilidades", nivel)
-            )
+        calificaciones = calificar("Habilidades", request.form)
 
-        ruta = siguiente_cuestionario(session["estudiante"])
-        return redirect(f"/{ruta}" if ruta else "/final")
+        return entregar(filas_resultado(calificaciones))
 
     return render_template("habilidades.html", alumno=alumno_actual())
 
+# familias se recorre completa: son cinco renglones y desde cada una se
+# busca por índice en cuestionarios y en los resultados del alumno.
+CONSULTA_FAMILIAS_HECHAS = """
+    SELECT DISTINCT familias.nombre
+    FROM resultados
+    JOIN cuestionarios ON cuestionarios.id = resultados.cuestionario_id
+    JOIN familias ON familias.id = cuestionarios.familia_id
+    WHERE resultados.estudiante_id=?
+"""
+
 def siguiente_cuestionario(estudiante_id):
-    with db() as con:
-        fila = con.execute(
-            "SELECT clase_id FROM estudiantes WHERE id=?",
-            (estudiante_id,)
-        ).fetchone()
+    clase_id = clase_de_alumno(estudiante_id)
 
-        if not fila:
-            return None
+    if clase_id is None:
+        return None
 
-        clase_id = fila["clase_id"]
+    plan = plan_clase(clase_id)
 
-        hechos = con.execute("""
-            SELECT cuestionario
-            FROM resultados
-            WHERE estudiante_id=?
-        """, (estudiante_id,)).fetchall()
+    with db() as con:
+        hechos = con.execute(CONSULTA_FAMILIAS_HECHAS, (estudiante_id,)).fetchall()
 
-        hechos = {h["cuestionario"] for h in hechos}
+    # Basta una escala de la familia (p. ej. un área del tamizaje)
+    hechos = {h["nombre"] for h in hechos}
 
-        pendientes = con.execute("""
-            SELECT cuestionario
-            FROM clase_cuestionarios
-            WHERE clase_id=?
-            ORDER BY rowid
-        """, (clase_id,)).fetchall()
+    for nombre in plan:
+        if nombre not in hechos:
+            return RUTAS_CUESTIONARIOS[nombre]
 
-        for p in pendientes:
-            nombre = p["cuestionario"]
+    return None
 
-            if nombre == "Batería de Tamizaje":
-                if any(h.startswith("Tamizaje -") for h in hechos):
-                    continue
-                return "tamizaje"
+app.config.update(
+    SESION_ALUMNO_SEGUNDOS=int(os.environ.get("SESION_ALUMNO_SEGUNDOS", 12 * 3600)),
+    REVOCACIONES_SYNC=30,
+    REVOCACIONES_MARGEN=int(os.environ.get("REVOCACIONES_MARGEN", 300))
+)
 
-            if nombre not in hechos:
-                return RUTAS_CUESTIONARIOS[nombre]
+def firmador_sesiones():
+    return URLSafeTimedSerializer(app.secret_key, salt="sesion-alumno")
+
+def emitir_token_alumno(estudiante_id, nombre, matricula, grupo, carrera):
+    return firmador_sesiones().dumps({
+        "id": estudiante_id,
+        "nombre": nombre,
+        "matricula": matricula,
+        "grupo": grupo,
+        "carrera": carrera
+    })
+
+CONSULTA_REVOCACIONES = """
+    SELECT estudiante_id, revocada_en
+    FROM sesiones
+    WHERE revocada_en >= ?
+"""
+
+class Revocaciones:
+    # Copia en memoria de sesiones.revocada_en; se refresca cada
+    # REVOCACIONES_SYNC segundos con una consulta sobre el índice.
+    # revocada_en se toma antes del commit, así que una transacción larga
+    # (p. ej. borrar una clase) puede confirmar una marca anterior a la
+    # última sincronización: cada lectura vuelve a cubrir los últimos
+    # REVOCACIONES_MARGEN segundos.
+    def __init__(self):
+        self.revocados = {}
+        self.marca = None
+        self.ultimo_sync = 0
+        self.lock = threading.Lock()
+
+    def agregar(self, ids, cuando):
+        with self.lock:
+            for estudiante_id in ids:
+                self.revocados[estudiante_id] = cuando
+
+    def contiene(self, estudiante_id):
+        self.sincronizar()
+        return estudiante_id in self.revocados
+
+    def sincronizar(self):
+        ahora = time.time()
+        if ahora - self.ultimo_sync < app.config["REVOCACIONES_SYNC"]:
+            return
+
+        with self.lock:
+            if ahora - self.ultimo_sync < app.config["REVOCACIONES_SYNC"]:
+                return
+
+            vigencia = app.config["SESION_ALUMNO_SEGUNDOS"]
+            desde = self.marca if self.marca is not None else int(ahora) - vigencia
+
+            for fila in db().execute(CONSULTA_REVOCACIONES, (desde,)):
+                self.revocados[fila["estudiante_id"]] = fila["revocada_en"]
+
+            # Un token revocado hace más de la vigencia ya expiró por sí solo
+            limite = ahora - vigencia
+            for estudiante_id, cuando in list(self.revocados.items()):
+                if cuando < limite:
+                    del self.revocados[estudiante_id]
+
+            self.marca = int(ahora) - app.config["REVOCACIONES_MARGEN"]
+            self.ultimo_sync = ahora
+
+revocaciones = Revocaciones()
+
+def revocar_sesiones(con, clase_id):
+    ahora = int(time.time())
+    ids = [
+        fila["id"] for fila in con.execute(
+            "SELECT id FROM estudiantes WHERE clase_id=?",
+            (clase_id,)
+        )
+    ]
+    con.execute("""
+        UPDATE sesiones SET revocada_en=?
+        WHERE estudiante_id IN (SELECT id FROM estudiantes WHERE clase_id=?)
+    """, (ahora, clase_id))
+    revocaciones.agregar(ids, ahora)
+
+def sesion_anterior():
+    # Sesiones abiertas antes de los tokens firmados: se validan una vez
+    # contra la tabla y se cambian por un token firmado.
+    with db() as con:
+        fila = con.execute("""
+            SELECT e.id, e.nombre, e.matricula, e.grupo, e.carrera
+            FROM sesiones s
+            JOIN estudiantes e ON e.id = s.estudiante_id
+            WHERE s.estudiante_id=? AND s.token=? AND s.revocada_en IS NULL
+        """, (session["estudiante"], session["token"])).fetchone()
 
-    return None
+    if not fila:
+        return None
 
-def alumno_actual():
-    if "estudiante" not in session:
+    session["token"] = emitir_token_alumno(*fila)
+    return dict(fila)
+
+def datos_sesion_alumno():
+    if "estudiante" not in session or "token" not in session:
         return None
 
-    with db() as con:
-        return con.execute("""
-            SELECT nombre, matricula, grupo, carrera
-            FROM estudiantes
-            WHERE id=?
-        """, (session["estudiante"],)).fetchone()
+    if "alumno" not in g:
+        try:
+            datos = firmador_sesiones().loads(
+                session["token"],
+                max_age=app.config["SESION_ALUMNO_SEGUNDOS"]
+            )
+        except SignatureExpired:
+            datos = None
+        except BadSignature:
+            datos = sesion_anterior()
+
+        if datos and (
+            datos["id"] != session["estudiante"]
+            or revocaciones.contiene(datos["id"])
+        ):
+            datos = None
+
+        g.alumno = datos
+
+    return g.alumno
+
+def alumno_actual():
+    return datos_sesion_alumno()
 
 def validar_sesion_alumno():
-    if "estudiante" not in session or "token" not in session:
-        return False
+    return datos_sesion_alumno() is not None
+
+app.config.setdefault("SALUD_LOTE", 500)
+
+CONSULTA_HISTORIAL_SALUD = """
+    SELECT r.id,
+           c.nombre AS clase,
+           e.id AS estudiante_id,
+           e.nombre AS alumno,
+           etiquetas.nombre AS nivel,
+           r.resultado
+    FROM resultados r
+    JOIN estudiantes e ON e.id = r.estudiante_id
+    JOIN clases c ON c.id = e.clase_id
+    LEFT JOIN etiquetas ON etiquetas.id = r.etiqueta_id
+    WHERE r.cuestionario_id = (SELECT id FROM cuestionarios WHERE nombre = 'Cuestionario de Salud')
+    AND r.id > ?
+    ORDER BY r.id
+    LIMIT ?
+"""
+
+def lotes_salud():
+    ultimo_id = 0
+    while True:
+        with db() as con:
+            filas = con.execute(
+                CONSULTA_HISTORIAL_SALUD, (ultimo_id, app.config["SALUD_LOTE"])
+            ).fetchall()
 
-    with db() as con:
-        fila = con.execute("""
-            SELECT token
-            FROM sesiones
-            WHERE estudiante_id=?
-        """, (session["estudiante"],)).fetchone()
+        if not filas:
+            return
 
-    return fila and fila["token"] == session["token"]
+        yield filas
+        ultimo_id = filas[-1]["id"]
 
 @app.route("/historial_salud")
 def historial_salud():
@@ -713,48 +4233,69 @@ def historial_salud():
         return redirect("/orientacion")
 
     with db() as con:
-        datos = con.execute("""
-            SELECT c.nombre AS clase,
-                   e.nombre AS alumno,
-                   r.resultado
-            FROM resultados r
-            JOIN estudiantes e ON e.id = r.estudiante_id
-            JOIN clases c ON c.id = e.clase_id
-            WHERE r.cuestionario = 'Cuestionario de Salud'
-            ORDER BY c.nombre, e.nombre
-        """).fetchall()
+        etiqueta = etiqueta_datos("historial_salud", version_datos(con))
+    respuesta = sin_cambios(etiqueta)
+    if respuesta:
+        return respuesta
 
-    return render_template("historial_salud.html", datos=datos)
+    datos = (fila for lote in lotes_salud() for fila in lote)
+
+    contexto = {"datos": datos}
+    app.update_template_context(contexto)
+    contenido = app.jinja_env.get_template("historial_salud.html").stream(contexto)
+    contenido.enable_buffering(64)
+
+    return con_etiqueta(
+        Response(stream_with_context(contenido), mimetype="text/html"),
+        etiqueta
+    )
+
+@app.route("/historial_salud/export.csv")
+def historial_salud_export():
+    if not session.get("admin"):
+        return redirect("/orientacion")
+
+    def generar():
+        salida = io.StringIO()
+        escritor = csv.writer(salida)
+        escritor.writerow(["clase", "alumno", "nivel"] + CAMPOS_SALUD)
+
+        # Fernet es CPU y no suelta el GIL: se descifra aquí mismo, lote por
+        # lote, mientras se escribe la respuesta.
+        for filas in lotes_salud():
+            for fila in filas:
+                _, respuestas = descifrar_salud(fila["nivel"], fila["resultado"])
+                respuestas = respuestas or {}
+                escritor.writerow(
+                    [fila["clase"], fila["alumno"], fila["nivel"]]
+                    + [respuestas.get(campo, "") for campo in CAMPOS_SALUD]
+                )
+            yield salida.getvalue()
+            salida.seek(0)
+            salida.truncate()
+
+    return Response(
+        stream_with_context(generar()),
+        mimetype="text/csv",
+        headers={"Content-Disposition": "attachment; filename=historial_salud.csv"}
+    )
 
 @app.route("/estilos", methods=["GET","POST"])
 def estilos():
     if "estudiante" not in session:
         return redirect("/")
 
-    if request.method == "POST":
-        respuestas = {
-            k: int(v)
-            for k, v in request.form.items()
-            if k.startswith("p")
-        }
-
-        estilos_calc = {
-            "Activo": respuestas["p1"] + respuestas["p5"] + respuestas["p9"] + respuestas["p13"] + respuestas["p17"],
-            "Reflexivo": respuestas["p2"] + respuestas["p6"] + respuestas["p10"] + respuestas["p14"] + respuestas["p18"],
-            "Teórico": respuestas["p3"] + respuestas["p7"] + respuestas["p11"] + respuestas["p15"] + respuestas["p19"],
-            "Pragmático": respuestas["p4"] + respuestas["p8"] + respuestas["p12"] + respuestas["p16"] + respuestas["p20"]
-        }
-
-        estilo_principal = max(estilos_calc, key=estilos_calc.get)
+    if not validar_sesion_alumno():
+        session.clear()
+        return redirect("/")
 
-        with db() as con:
-            con.execute(
-                "INSERT INTO resultados (estudiante_id, cuestionario, resultado) VALUES (?,?,?)",
-                (session["estudiante"], "Estilos de aprendizaje", estilo_principal)
-            )
+    if request.method == "POST":
+        try:
+            calificaciones = calificar("Estilos de aprendizaje", request.form)
+        except ValueError:
+            return "Error: faltan respuestas en el cuestionario", 400
 
-        ruta = siguiente_cuestionario(session["estudiante"])
-        return redirect(f"/{ruta}" if ruta else "/final")
+        return entregar(filas_resultado(calificaciones))
 
     return render_template("estilos.html")
 
@@ -763,32 +4304,17 @@ def autoestima():
     if "estudiante" not in session:
         return redirect("/")
 
-    if request.method == "POST":
-        respuestas = {}
-
-        for k, v in request.form.items():
-            if k.startswith("p") and v.isdigit():
-                respuestas[k] = int(v)
+    if not validar_sesion_alumno():
+        session.clear()
+        return redirect("/")
 
-        if len(respuestas) != 10:
+    if request.method == "POST":
+        try:
+            calificaciones = calificar("Autoestima Rosenberg", request.form)
+        except ValueError:
             return "Error: faltan respuestas en el cuestionario", 400
 
-        puntaje = sum(respuestas.values())
-
-        nivel = (
-            "Autoestima Baja" if puntaje <= 15 else
-            "Autoestima Media" if puntaje <= 25 else
-            "Autoestima Alta"
-        )
-
-        with db() as con:
-            con.execute(
-                "INSERT INTO resultados VALUES (NULL,?,?,?)",
-                (session["estudiante"], "Autoestima Rosenberg", nivel)
-            )
-
-        ruta = siguiente_cuestionario(session["estudiante"])
-        return redirect(f"/{ruta}" if ruta else "/final")
+        return entregar(filas_resultado(calificaciones))
 
     return render_template("autoestima.html")
 
@@ -797,47 +4323,17 @@ def tamizaje():
     if "estudiante" not in session:
         return redirect("/")
 
-    if request.method == "POST":
-        dep = sum(int(request.form[f"d{i}"]) for i in range(1, 3))
-        dep_resultado = "Sin indicios" if dep <= 2 else "Requiere evaluación"
-
-        anx = sum(int(request.form[f"a{i}"]) for i in range(1, 3))
-        anx_resultado = "Sin indicios" if anx <= 2 else "Requiere evaluación"
-
-        alcohol = sum(int(request.form[f"al{i}"]) for i in range(1, 4))
-        alcohol_resultado = "Consumo de riesgo" if alcohol >= 4 else "Sin riesgo"
-
-        neuro = sum(int(request.form[f"n{i}"]) for i in range(1, 18))
-
-        if neuro <= 16:
-            neuro_resultado = "No significativo"
-        elif neuro <= 28:
-            neuro_resultado = "Leve"
-        elif neuro <= 40:
-            neuro_resultado = "Moderado"
-        else:
-            neuro_resultado = "Elevado"
-
-        resultado_final = (
-            f"Depresión: {dep_resultado} | "
-            f"Ansiedad: {anx_resultado} | "
-            f"Alcohol: {alcohol_resultado} | "
-            f"Neurodivergencia: {neuro_resultado}"
-        )
+    if not validar_sesion_alumno():
+        session.clear()
+        return redirect("/")
 
-        with db() as con:
-            con.executemany(
-                "INSERT INTO resultados (estudiante_id, cuestionario, resultado) VALUES (?,?,?)",
-                [
-                    (session["estudiante"], "Tamizaje - Depresión", dep_resultado),
-                    (session["estudiante"], "Tamizaje - Ansiedad", anx_resultado),
-                    (session["estudiante"], "Tamizaje - Alcohol", alcohol_resultado),
-                    (session["estudiante"], "Tamizaje - Neurodivergencia", neuro_resultado),
-                ]
-            )
+    if request.method == "POST":
+        try:
+            calificaciones = calificar("Batería de Tamizaje", request.form)
+        except ValueError:
+            return "Error: faltan respuestas en el cuestionario", 400
 
-        ruta = siguiente_cuestionario(session["estudiante"])
-        return redirect(f"/{ruta}" if ruta else "/final")
+        return entregar(filas_resultado(calificaciones))
 
     return render_template("tamizaje.html")
 
@@ -850,38 +4346,14 @@ def salud():
     alumno = alumno_actual()
 
     if request.method == "POST":
+        [(_, nivel, _)] = calificar("Cuestionario de Salud", request.form)
 
-        puntos = 0
-        for v in request.form.values():
-            if v.lower() == "si":
-                puntos += 1
-
-        if puntos <= 2:
-            nivel = "Salud adecuada"
-        elif puntos <= 5:
-            nivel = "Riesgo leve"
-        elif puntos <= 8:
-            nivel = "Riesgo moderado"
-        else:
-            nivel = "Riesgo alto"
-
-        respuestas = dict(request.form)
-
-        texto = nivel + " | " + json.dumps(respuestas)
-        resultado_cifrado = fernet.encrypt(texto.encode()).decode()
-
-        with db() as con:
-            con.execute("""
-                INSERT INTO resultados (estudiante_id, cuestionario, resultado)
-                VALUES (?,?,?)
-            """, (
-                session["estudiante"],
-                "Cuestionario de Salud",
-                resultado_cifrado
-            ))
+        respuestas_cifradas = cifrar_respuestas(dict(request.form))
 
-        ruta = siguiente_cuestionario(session["estudiante"])
-        return redirect(f"/{ruta}" if ruta else "/final")
+        # Las respuestas de salud solo se guardan cifradas
+        return entregar([
+            ("Cuestionario de Salud", respuestas_cifradas, nivel, None)
+        ])
 
     return render_template("salud.html", alumno=alumno)
 
@@ -891,4 +4363,4 @@ def final():
     return render_template("final.html")
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    create_app().run(host="0.0.0.0", port=5000, debug=True)
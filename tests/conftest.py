@@ -0,0 +1,82 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def modulo(tmp_path, monkeypatch):
+    # Cada prueba con su propia base, archivos y cachés vacías
+    from cryptography.fernet import Fernet
+
+    monkeypatch.setenv("FERNET_KEY", Fernet.generate_key().decode())
+    import app as modulo
+
+    monkeypatch.setattr(modulo, "DB", str(tmp_path / "database.db"))
+    monkeypatch.setattr(modulo, "pool", None)
+    monkeypatch.setattr(modulo, "fernet", None)
+    for clave, valor in {
+        "TESTING": True,
+        "ARCHIVO_DIR": str(tmp_path / "archivo"),
+        "CONSULTAS_LENTAS_MS": 0,
+        "ESCRITURA_AGRUPADA": False,
+        "MANTENIMIENTO": False,
+    }.items():
+        monkeypatch.setitem(modulo.app.config, clave, valor)
+
+    for cache in (
+        modulo.planes_clase, modulo.clases_alumno, modulo.detalles_salud,
+        modulo.archivos_clase, modulo.fragmentos_dashboard.memoria
+    ):
+        cache.vaciar()
+    for codigos in modulo.codigos_cache.values():
+        codigos.clear()
+    modulo.revocaciones.revocados.clear()
+
+    con = modulo.conectar()
+    modulo.migrar(con)
+    con.close()
+    return modulo
+
+
+@pytest.fixture
+def admin(modulo):
+    cliente = modulo.app.test_client()
+    with cliente.session_transaction() as s:
+        s["admin"] = True
+    return cliente
+
+
+@pytest.fixture
+def crear_clase(modulo, admin):
+    def crear(nombre, cuestionarios):
+        admin.post("/dashboard", data={"nombre": nombre, "cuestionarios": cuestionarios})
+        con = modulo.conectar()
+        clase = con.execute(
+            "SELECT id, codigo FROM clases WHERE nombre=? ORDER BY id DESC",
+            (nombre,)
+        ).fetchone()
+        con.close()
+        return clase["id"], clase["codigo"]
+    return crear
+
+
+@pytest.fixture
+def alumno(modulo):
+    # Registra un alumno y contesta los cuestionarios dados en orden
+    def registrar(clase_id, codigo, nombre, contestar):
+        cliente = modulo.app.test_client()
+        cliente.get(f"/c/{codigo}")
+        cliente.post("/registro", data={
+            "nombre": nombre,
+            "matricula": nombre[:3].upper(),
+            "carrera": "Industrial",
+            "clase_id": str(clase_id)
+        })
+        for ruta, respuestas in contestar:
+            respuesta = cliente.post(f"/{ruta}", data=respuestas)
+            assert respuesta.status_code == 302
+        return cliente
+    return registrar
@@ -0,0 +1,18 @@
+import pytest
+
+AUTOESTIMA = {f"p{i}": "2" for i in range(1, 11)}
+
+
+@pytest.mark.parametrize("por_pagina, esperados", [
+    ("0", 1), ("-1", 1), ("2", 2), ("abc", 3), ("100000", 3)
+])
+def test_por_pagina_acotado(modulo, admin, crear_clase, alumno, por_pagina, esperados):
+    clase_id, codigo = crear_clase("Grupo C", ["Autoestima Rosenberg"])
+    for nombre in ("Ana", "Beto", "Carla"):
+        alumno(clase_id, codigo, nombre, [("autoestima", AUTOESTIMA)])
+
+    respuesta = admin.get(f"/clase/{clase_id}/alumnos?por_pagina={por_pagina}")
+    assert respuesta.status_code == 200
+    html = respuesta.get_data(as_text=True)
+    assert sum(nombre in html for nombre in ("Ana", "Beto", "Carla")) == esperados
+    assert ("Siguiente página" in html) == (esperados < 3)
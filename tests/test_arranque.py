@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Importar app con sqlite3.connect y os.walk bloqueados: cualquier intento
+# de abrir la base o recorrer plantillas falla la importación.
+IMPORTAR = f"""
+import os, sqlite3, sys
+
+def prohibido(*args, **kwargs):
+    raise AssertionError("importar app no debe llamar esto")
+
+sqlite3.connect = prohibido
+os.walk = prohibido
+sys.path.insert(0, {RAIZ!r})
+import app
+"""
+
+
+def test_importar_no_abre_la_base_ni_escribe(tmp_path):
+    entorno = dict(
+        os.environ,
+        CACHE_FRAGMENTOS_DIR=str(tmp_path / "fragmentos"),
+    )
+    entorno.pop("FERNET_KEY", None)
+    entorno.pop("ETAG_SEMILLA", None)
+
+    resultado = subprocess.run(
+        [sys.executable, "-c", IMPORTAR],
+        cwd=tmp_path, env=entorno, capture_output=True, text=True
+    )
+
+    assert resultado.returncode == 0, resultado.stderr
+    assert os.listdir(tmp_path) == []
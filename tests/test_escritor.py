@@ -0,0 +1,27 @@
+import sqlite3
+
+import pytest
+
+FILAS = [("Autoestima Rosenberg", "Autoestima Alta", None, None)]
+
+
+def test_escritor_reabre_su_conexion(modulo, crear_clase, alumno):
+    clase_id, codigo = crear_clase("Grupo A", ["Autoestima Rosenberg"])
+    alumno(clase_id, codigo, "Ana", [])
+    con = modulo.conectar()
+    estudiante_id = con.execute("SELECT id FROM estudiantes").fetchone()["id"]
+
+    escritor = modulo.EscritorAgrupado(10, 0.001, 5)
+    escritor.enviar(estudiante_id, FILAS)
+    assert escritor.con.execute("PRAGMA synchronous").fetchone()[0] == 2
+
+    # Una conexión rota falla su lote y el siguiente abre otra
+    escritor.con.close()
+    with pytest.raises(sqlite3.Error):
+        escritor.enviar(estudiante_id, FILAS)
+    escritor.enviar(estudiante_id, FILAS)
+
+    assert con.execute("SELECT COUNT(*) FROM resultados").fetchone()[0] == 2
+    # No se queda con conexiones del pool de los workers
+    assert modulo.pool.prestadas == 0
+    con.close()
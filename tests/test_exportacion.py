@@ -0,0 +1,24 @@
+AUTOESTIMA_BAJA = {f"p{i}": "1" for i in range(1, 11)}
+
+
+def test_exportacion_usa_el_ultimo_resultado(modulo, crear_clase, alumno):
+    clase_id, codigo = crear_clase("Grupo A", ["Autoestima Rosenberg"])
+    alumno(clase_id, codigo, "Ana", [("autoestima", AUTOESTIMA_BAJA)])
+
+    # Un resultado posterior (p. ej. importado) con una etiqueta que va
+    # antes en el alfabeto
+    con = modulo.conectar()
+    with con:
+        con.execute("""
+            INSERT INTO resultados (estudiante_id, cuestionario_id, etiqueta_id)
+            SELECT estudiante_id, cuestionario_id,
+                   (SELECT id FROM etiquetas WHERE nombre = 'Autoestima Alta')
+            FROM resultados
+        """)
+    con.close()
+
+    with modulo.app.app_context():
+        [fila] = list(modulo.filas_exportacion([{"id": clase_id, "nombre": "Grupo A"}]))
+
+    columna = modulo.ENCABEZADO_EXPORTACION.index("Autoestima")
+    assert fila[columna] == "Autoestima Alta"
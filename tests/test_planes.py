@@ -0,0 +1,124 @@
+import random
+import time
+
+CLASES = 60
+ALUMNOS_POR_CLASE = 40
+
+# (constante, formato, parámetros, tablas que sí pueden recorrerse completas);
+# cada recorrido aceptado está explicado junto a su consulta en app.py.
+CONSULTAS = [
+    ("CONSULTA_FAMILIAS_HECHAS", None, (7,), {"familias"}),
+    ("CONSULTA_PRIMERA_ENTREGA", None, (7,), set()),
+    # Las secciones del dashboard muestran una fila por clase
+    ("CONSULTA_ENTREGAS", None, (), {"clases"}),
+    ("CONSULTA_AUTOESTIMA_BAJA", None, (), {"clases"}),
+    ("CONSULTA_TAMIZAJE_RIESGO", None, (), {"clases", "resumen"}),
+    ("CONSULTA_SALUD_RIESGO", None, (), {"clases"}),
+    ("VERSIONES_CLASES_FAMILIA", None, ("Batería de Tamizaje",), {"v"}),
+    ("VERSIONES_CLASES_VIVAS", None, (), {"clases"}),
+    ("LISTA_CLASES", None, (), {"clases", "clases_archivadas"}),
+    ("CONSULTA_ESTADISTICAS_CLASE", None, (3,), set()),
+    ("CONSULTA_RESULTADOS_CLASE", None, (3, "Autoestima Rosenberg"), set()),
+    ("CONSULTA_PAGINA_ALUMNOS", {"condiciones": "e.clase_id=?"}, (3, 51), set()),
+    ("CONSULTA_PAGINA_ALUMNOS", {"condiciones": """
+        e.clase_id=?
+        AND e.id IN (SELECT rowid FROM estudiantes_fts WHERE estudiantes_fts MATCH ?)
+        AND (e.nombre, e.id) > (?, ?)
+    """}, (3, '{nombre matricula} : "lumno"', "Alumno 10", 0, 51), set()),
+    ("CONSULTA_RESULTADOS_ALUMNOS", {"ids": "?,?,?", "filtro": ""}, (1, 2, 3), set()),
+    ("CONSULTA_EXPORTACION", {"columnas": "COLUMNA_EXPORTACION"}, (1, 3), set()),
+    ("CONSULTA_REVOCACIONES", None, (int(time.time()) - 60,), set()),
+    ("CONSULTA_RESULTADOS_POR_BORRAR", None, (3,), set()),
+    ("CONSULTA_SESIONES_REVOCADAS", None, (int(time.time()) - 86400,), set()),
+    ("CONSULTA_SESIONES_VIEJAS", None, (int(time.time()) - 90 * 86400,), set()),
+    ("CONSULTA_TENDENCIA", {"condiciones": """
+        t.periodo=?
+        AND t.cuestionario_id = (SELECT id FROM cuestionarios WHERE nombre=?)
+        AND t.inicio >= ? AND t.inicio <= ?
+    """}, ("semana", "Autoestima Rosenberg", "2020-01-01", "2030-01-01"), set()),
+    ("CONSULTA_TENDENCIA", {"condiciones": """
+        t.periodo=?
+        AND t.cuestionario_id = (SELECT id FROM cuestionarios WHERE nombre=?)
+        AND t.clase_id=?
+    """}, ("semana", "Autoestima Rosenberg", 3), set()),
+    ("CONSULTA_SALUD_SIN_NIVEL", None, (0, 500), set()),
+    ("CONSULTA_DETALLE_SALUD", None, (7,), set()),
+    ("CONSULTA_HISTORIAL_SALUD", None, (0, 500), set()),
+]
+
+
+def poblar(modulo, con):
+    # Una institución mediana: todas las clases contestaron todo, algunas
+    # sesiones revocadas y unas clases archivadas. Las estadísticas se toman
+    # ya con los datos, como las deja el mantenimiento.
+    azar = random.Random(1)
+    cuestionarios = {f["nombre"]: f["id"] for f in con.execute("SELECT id, nombre FROM cuestionarios")}
+    etiquetas = [f["id"] for f in con.execute("SELECT id FROM etiquetas")]
+    ahora = int(time.time())
+
+    with con:
+        for clase in range(1, CLASES + 1):
+            con.execute(
+                "INSERT INTO clases (id, nombre, codigo) VALUES (?,?,?)",
+                (clase, f"Grupo {clase}", f"C{clase:05d}")
+            )
+            con.execute("INSERT INTO versiones_datos (clase_id, version) VALUES (?, 1)", (clase,))
+            con.executemany(
+                "INSERT INTO clase_cuestionarios (clase_id, cuestionario) VALUES (?,?)",
+                [(clase, nombre) for nombre in modulo.CUESTIONARIOS]
+            )
+            for n in range(ALUMNOS_POR_CLASE):
+                estudiante_id = con.execute(
+                    "INSERT INTO estudiantes (nombre, matricula, grupo, carrera, clase_id) VALUES (?,?,?,?,?)",
+                    (f"Alumno {n} de {clase}", f"M{clase}{n}", "A", "Industrial", clase)
+                ).lastrowid
+                con.executemany(
+                    "INSERT INTO resultados (estudiante_id, cuestionario_id, etiqueta_id, resultado, creado_en) VALUES (?,?,?,?,?)",
+                    [
+                        (estudiante_id, cuestionario_id, azar.choice(etiquetas), None,
+                         ahora - azar.randrange(180 * 86400))
+                        for cuestionario_id in cuestionarios.values()
+                    ]
+                )
+                con.execute(
+                    "INSERT INTO sesiones (estudiante_id, token, creada_en, revocada_en) VALUES (?,?,?,?)",
+                    (estudiante_id, "t", ahora - azar.randrange(30 * 86400),
+                     ahora - azar.randrange(86400) if azar.random() < 0.05 else None)
+                )
+        con.executemany(
+            "INSERT INTO clases_archivadas (id, nombre, archivo, archivada_en) VALUES (?,?,?,?)",
+            [(CLASES + i, f"Viejo {i}", f"clase_{CLASES + i}.sqlite.gz", ahora) for i in range(1, 6)]
+        )
+        modulo.reconstruir_resumen(con)
+    con.execute("ANALYZE")
+
+
+def recorridos(con, sql, params, permitidas):
+    fallas = []
+    for paso in con.execute("EXPLAIN QUERY PLAN " + sql, params):
+        detalle = paso["detail"]
+        if not detalle.startswith("SCAN "):
+            continue
+        tabla = detalle.split()[1]
+        if "VIRTUAL TABLE INDEX" in detalle or tabla.startswith("(subquery") or tabla in permitidas:
+            continue
+        fallas.append(detalle)
+    return fallas
+
+
+def test_consultas_frecuentes_usan_indices(modulo):
+    con = modulo.conectar()
+    poblar(modulo, con)
+
+    fallas = {}
+    for nombre, formato, params, permitidas in CONSULTAS:
+        sql = getattr(modulo, nombre)
+        if formato:
+            # Un valor que nombra otra constante de app se sustituye por ella
+            sql = sql.format(**{k: getattr(modulo, v, v) for k, v in formato.items()})
+        pasos = recorridos(con, sql, params, permitidas)
+        if pasos:
+            fallas[nombre] = pasos
+    con.close()
+
+    assert fallas == {}
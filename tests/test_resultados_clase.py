@@ -0,0 +1,60 @@
+ESTILOS = {f"p{i}": "5" if i % 4 == 1 else "1" for i in range(1, 21)}
+AUTOESTIMA = {f"p{i}": "4" for i in range(1, 11)}
+
+
+def test_resultados_clase_viva_y_archivada(modulo, admin, crear_clase, alumno):
+    clase_id, codigo = crear_clase("Grupo A", ["Estilos de aprendizaje", "Autoestima Rosenberg"])
+    alumno(clase_id, codigo, "Ana", [("estilos", ESTILOS), ("autoestima", AUTOESTIMA)])
+
+    viva = admin.get(f"/clase/{clase_id}/resultados")
+    assert viva.status_code == 200
+    html = viva.get_data(as_text=True)
+    assert "Grupo A" in html
+    assert "Activo" in html
+    assert "Autoestima Alta" in html
+    assert "Clase archivada" not in html
+
+    assert admin.post(f"/archivar_clase/{clase_id}").status_code == 302
+
+    archivada = admin.get(f"/clase/{clase_id}/resultados")
+    assert archivada.status_code == 200
+    html = archivada.get_data(as_text=True)
+    assert "Grupo A" in html
+    assert "Activo" in html
+    assert "Autoestima Alta" in html
+    assert "Clase archivada" in html
+
+
+def test_resultados_clase_inexistente(admin):
+    assert admin.get("/clase/999/resultados").status_code == 404
+
+
+def test_archivo_faltante_o_danado(modulo, admin, crear_clase, alumno):
+    import os
+
+    clase_id, codigo = crear_clase("Grupo B", ["Autoestima Rosenberg"])
+    alumno(clase_id, codigo, "Beto", [("autoestima", AUTOESTIMA)])
+    admin.post(f"/archivar_clase/{clase_id}")
+    ruta = os.path.join(modulo.app.config["ARCHIVO_DIR"], f"clase_{clase_id}.sqlite.gz")
+
+    with open(ruta, "wb") as f:
+        f.write(b"no es gzip")
+    modulo.archivos_clase.vaciar()
+    assert admin.get(f"/clase/{clase_id}/resultados").status_code == 404
+    assert admin.get(f"/clase/{clase_id}/alumnos").status_code == 404
+
+    os.remove(ruta)
+    assert admin.get(f"/clase/{clase_id}/resultados").status_code == 404
+
+
+def test_cache_de_archivos_limitada_por_bytes(modulo):
+    cache = modulo.CacheLRU(10, maximo_bytes=100)
+    cache.put(1, b"x" * 60)
+    cache.put(2, b"x" * 30)
+    cache.put(3, b"x" * 30)
+    assert list(cache.datos) == [2, 3]
+    assert cache.bytes == 60
+
+    cache.put(4, b"x" * 200)
+    assert 4 not in cache.datos
+    assert cache.bytes == 60
@@ -0,0 +1,23 @@
+import time
+
+
+def test_revocacion_confirmada_despues_de_sincronizar(modulo):
+    con = modulo.conectar()
+    ahora = int(time.time())
+    with con:
+        con.executemany(
+            "INSERT INTO sesiones (estudiante_id, token, creada_en) VALUES (?,?,?)",
+            [(1, "a", ahora), (2, "b", ahora)]
+        )
+        con.execute("UPDATE sesiones SET revocada_en=? WHERE estudiante_id=2", (ahora,))
+
+    revocaciones = modulo.Revocaciones()
+    with modulo.app.app_context():
+        assert revocaciones.contiene(2)
+
+        # La marca se tomó antes de esa sincronización, el commit llegó después
+        with con:
+            con.execute("UPDATE sesiones SET revocada_en=? WHERE estudiante_id=1", (ahora - 20,))
+        revocaciones.ultimo_sync = 0
+        assert revocaciones.contiene(1)
+    con.close()